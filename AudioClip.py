@@ -1,5 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List
+import numpy as np
 from AudioEvent import AudioEvent
 
 
@@ -8,3 +9,26 @@ class AudioClip:
     events: List[AudioEvent]
     sample_rate: int = 44100
     num_channels: int = 1
+    # Per-event features like start, duration and pitch as float64 arrays, so strategies match against them without
+    # going through the events. Given at construction where they are at hand, otherwise gathered on first use
+    feature_arrays: dict[str, np.ndarray] = field(default_factory=dict, repr=False)
+
+    def event_feature(self, name: str) -> np.ndarray:
+        array = self.feature_arrays.get(name)
+        if array is None:
+            array = np.array([getattr(event, name) for event in self.events], dtype=np.float64)
+            self.feature_arrays[name] = array
+        return array
+
+    def select(self, event_ids: np.ndarray) -> "AudioClip":
+        return AudioClip([self.events[i] for i in event_ids], self.sample_rate, self.num_channels,
+                         feature_arrays={name: array[event_ids] for name, array in self.feature_arrays.items()})
+
+    @property
+    def offset(self) -> int:
+        return min((event.start for event in self.events), default=0)
+
+    @property
+    def length(self) -> int:
+        # Span from the first event start to the end of the last event, which is what gets rendered
+        return max((event.start + event.duration for event in self.events), default=0) - self.offset
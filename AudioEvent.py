@@ -1,36 +1,35 @@
-import copy
 from dataclasses import dataclass
-from typing import List
+from typing import Optional
 import numpy as np
-import audio_utils
+from AudioSource import AudioSource
 
 
 @dataclass
 class AudioEvent:
     start: int
     duration: int
-    pitch: int
-    _audio_data: List[float]
+    pitch: float
+    # (channels, frames) audio of the event, which may continue past its end
+    _audio_data: Optional[np.ndarray]
     rms: float
     should_fade_in: bool = True
-    _faded_audio_data: np.ndarray = None
+    # Events created without audio data are decoded from their source on first access
+    source: Optional[AudioSource] = None
+    peak: float = 0
+    spectral_centroid: float = 0
+    spectral_flatness: float = 0
+    mfcc: Optional[np.ndarray] = None
 
     @property
-    def audio_data(self):
-        if self._faded_audio_data is None:
-            self._faded_audio_data = self.apply_fade(self._audio_data, self.should_fade_in, self.duration)
-        return self._faded_audio_data
+    def raw_audio_data(self):
+        if self._audio_data is None and self.source is not None:
+            self._audio_data = self.source.read()
+        return self._audio_data
 
-    def apply_new_fade(self):
-        self._faded_audio_data = self.apply_fade(self._audio_data, self.should_fade_in, self.duration)
-
-    @staticmethod
-    def apply_fade(audio_data: list[float], should_fade_in: bool, duration: int) -> np.ndarray:
-        if len(audio_data) > duration:
-            audio_data = copy.copy(audio_data[0:duration])
-        result = np.array(audio_data)
-        if should_fade_in and len(audio_data) > len(audio_utils.default_fade_in_curve):
-            result[0:len(audio_utils.default_fade_in_curve)] *= audio_utils.default_fade_in_curve
-        if len(audio_data) > len(audio_utils.default_fade_out_curve):
-            result[-len(audio_utils.default_fade_out_curve):] *= audio_utils.default_fade_out_curve
-        return result
+    def audio_with_tail(self, tail: int = 0) -> np.ndarray:
+        # The audio of the event up to the end of its slot, followed by tail frames of the audio that comes after the
+        # event in its file. Audio data that does not reach that far is read again from the source
+        length = min(self.duration, self.raw_audio_data.shape[-1] if self.source is None else self.source.length)
+        if self.source is not None and (self._audio_data is None or self._audio_data.shape[-1] < length + tail):
+            self._audio_data = self.source.read(tail)
+        return self._audio_data[..., :length + tail]
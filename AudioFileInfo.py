@@ -0,0 +1,13 @@
+import pathlib
+from dataclasses import dataclass
+
+
+@dataclass
+class AudioFileInfo:
+    path: pathlib.Path
+    frames: int
+    samplerate: float
+    num_channels: int
+    duration: float
+    size: int
+    mtime_ns: int
@@ -0,0 +1,200 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+import numpy as np
+from pedalboard_native.io import AudioFile
+
+import audio_utils
+from Logger import span
+from pcm_cache import PcmCache, PcmReader, is_compressed
+
+# Files up to this length are decoded completely the first time they are read, so that later reads are plain slices
+WHOLE_FILE_DECODE_THRESHOLD_SECONDS = 30
+# Extra audio decoded on both sides of a range that is resampled on its own, so the filter has context at the edges
+RESAMPLE_PADDING_FRAMES = 1024
+
+
+@dataclass
+class AudioFilePool:
+    max_open_files: int = 64
+    max_buffer_bytes: int = 256 * 1024 * 1024
+    handle_hits: int = 0
+    handle_misses: int = 0
+    buffer_hits: int = 0
+    buffer_misses: int = 0
+    pcm_hits: int = 0
+    # When set, compressed files are read from memory mapped PCM instead of being decoded from their handles
+    pcm_cache: Optional[PcmCache] = None
+    _handles: OrderedDict = field(default_factory=OrderedDict)
+    _pcm: OrderedDict = field(default_factory=OrderedDict)
+    _buffers: OrderedDict = field(default_factory=OrderedDict)
+    _buffer_bytes: int = 0
+    _lock: threading.RLock = field(default_factory=threading.RLock)
+    _pid: int = field(default_factory=os.getpid)
+
+    def open(self, filename: str) -> AudioFile:
+        with self._lock:
+            self._check_process()
+            handle = self._handles.get(filename)
+            if handle is not None:
+                self.handle_hits += 1
+                self._handles.move_to_end(filename)
+                return handle
+            self.handle_misses += 1
+            handle = AudioFile(filename)
+            self._handles[filename] = handle
+            while len(self._handles) > self.max_open_files:
+                _, evicted = self._handles.popitem(last=False)
+                evicted.close()
+            return handle
+
+    def frames(self, filename: str, sample_rate: Optional[int] = None) -> int:
+        with self._lock:
+            file = self.open(filename)
+            if sample_rate is None:
+                return file.frames
+            return audio_utils.resampled_length(file.frames, file.samplerate, sample_rate)
+
+    def samplerate(self, filename: str) -> int:
+        with self._lock:
+            return int(self.open(filename).samplerate)
+
+    def pcm(self, filename: str) -> Optional[np.ndarray]:
+        if self.pcm_cache is None or not is_compressed(filename):
+            return None
+        with self._lock:
+            self._check_process()
+            samples = self._pcm.get(filename)
+            if samples is not None:
+                self._pcm.move_to_end(filename)
+                return samples
+            file = self.open(filename)
+            if not self.pcm_cache.fits(file.frames, file.num_channels):
+                return None
+            samples = self.pcm_cache.load(filename, file.num_channels)
+            self._pcm[filename] = samples
+            while len(self._pcm) > self.max_open_files:
+                self._pcm.popitem(last=False)
+            return samples
+
+    def open_reader(self, filename: str) -> Union[AudioFile, PcmReader]:
+        # A reader of its own, positioned independently of the pooled handles. The caller closes it
+        samples = self.pcm(filename)
+        if samples is None:
+            return AudioFile(filename)
+        return PcmReader(samples, self.samplerate(filename))
+
+    def read(self, filename: str, start: int, length: int, sample_rate: Optional[int] = None) -> np.ndarray:
+        # Returns a read-only (channels, frames) view; callers that modify samples must copy them first. With a sample
+        # rate, start and length are in frames at that rate and the audio is resampled to it
+        with self._lock:
+            self._check_process()
+            native_rate = self.samplerate(filename)
+            if sample_rate is None or int(sample_rate) == native_rate:
+                return self._read_native(filename, start, length)
+            return self._read_resampled(filename, start, length, native_rate, int(sample_rate))
+
+    def _read_native(self, filename: str, start: int, length: int) -> np.ndarray:
+        samples = self.pcm(filename)
+        if samples is not None:
+            self.pcm_hits += 1
+            return samples[:, start:start + length]
+        buffer = self._buffers.get(filename)
+        if buffer is not None:
+            self.buffer_hits += 1
+            self._buffers.move_to_end(filename)
+            return buffer[:, start:start + length]
+        self.buffer_misses += 1
+        file = self.open(filename)
+        with span("decode") as details:
+            if file.duration <= WHOLE_FILE_DECODE_THRESHOLD_SECONDS:
+                file.seek(0)
+                buffer = file.read(file.frames)
+                buffer.flags.writeable = False
+                details["samples"] = buffer.shape[-1]
+                self._store_buffer(filename, buffer)
+                return buffer[:, start:start + length]
+            file.seek(min(start, max(file.frames - 1, 0)))
+            samples = file.read(length)
+            samples.flags.writeable = False
+            details["samples"] = samples.shape[-1]
+            return samples
+
+    def _read_resampled(self, filename: str, start: int, length: int, native_rate: int, sample_rate: int) -> np.ndarray:
+        key = (filename, sample_rate)
+        buffer = self._buffers.get(key)
+        if buffer is not None:
+            self.buffer_hits += 1
+            self._buffers.move_to_end(key)
+            return buffer[:, start:start + length]
+        file = self.open(filename)
+        if self.pcm(filename) is None and file.duration <= WHOLE_FILE_DECODE_THRESHOLD_SECONDS:
+            # Short files are resampled as a whole once, after which reads are plain slices again
+            native = self._read_native(filename, 0, file.frames)
+            with span("resample", native.shape[-1]):
+                buffer = audio_utils.resample(native, native_rate, sample_rate)
+            buffer.flags.writeable = False
+            self._store_buffer(key, buffer)
+            return buffer[:, start:start + length]
+        # Longer files are resampled around the requested range only. The range is widened to start on a native frame
+        # that coincides with a frame at the target rate, so that the result lines up exactly
+        divisor = math.gcd(native_rate, sample_rate)
+        native_step, target_step = native_rate // divisor, sample_rate // divisor
+        first_step = max(start // target_step - math.ceil(RESAMPLE_PADDING_FRAMES / native_step), 0)
+        native_start = first_step * native_step
+        native_end = math.ceil((start + length) * native_rate / sample_rate) + RESAMPLE_PADDING_FRAMES
+        native = self._read_native(filename, native_start, native_end - native_start)
+        with span("resample", native.shape[-1]):
+            resampled = audio_utils.resample(native, native_rate, sample_rate)
+        offset = start - first_step * target_step
+        samples = resampled[:, offset:offset + length]
+        samples.flags.writeable = False
+        return samples
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "handle_hits": self.handle_hits,
+            "handle_misses": self.handle_misses,
+            "buffer_hits": self.buffer_hits,
+            "buffer_misses": self.buffer_misses,
+            "pcm_hits": self.pcm_hits,
+            "pcm_files": len(self._pcm),
+            "open_files": len(self._handles),
+            "buffer_bytes": self._buffer_bytes
+        }
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles.clear()
+            self._buffers.clear()
+            self._pcm.clear()
+            self._buffer_bytes = 0
+
+    def _store_buffer(self, key: Union[str, tuple[str, int]], buffer: np.ndarray):
+        # Native buffers are stored by filename, resampled ones by filename and sample rate
+        if buffer.nbytes > self.max_buffer_bytes:
+            return
+        self._buffers[key] = buffer
+        self._buffer_bytes += buffer.nbytes
+        while self._buffer_bytes > self.max_buffer_bytes:
+            _, evicted = self._buffers.popitem(last=False)
+            self._buffer_bytes -= evicted.nbytes
+
+    def _check_process(self):
+        # Open handles must not be shared with forked worker processes, since they share file positions
+        if self._pid != os.getpid():
+            self._handles = OrderedDict()
+            self._buffers = OrderedDict()
+            self._pcm = OrderedDict()
+            self._buffer_bytes = 0
+            self._lock = threading.RLock()
+            self._pid = os.getpid()
+
+
+shared_pool = AudioFilePool()
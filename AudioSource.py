@@ -0,0 +1,21 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from AudioFilePool import shared_pool
+
+
+@dataclass
+class AudioSource:
+    filename: str
+    offset: int
+    length: int
+    # Offset and length are in frames at this rate, which the audio is resampled to if the file has a different one
+    sample_rate: Optional[int] = None
+
+    def read(self, tail: int = 0) -> np.ndarray:
+        # With a tail, that many frames following the event are read as well, as far as the file goes
+        frames = shared_pool.frames(self.filename, self.sample_rate)
+        return shared_pool.read(self.filename, min(self.offset, max(frames - 1, 0)), self.length + tail,
+                                self.sample_rate)
@@ -1,7 +1,10 @@
 from dataclasses import dataclass, field
+from typing import Optional
 
 import numpy as np
 
+from helpers import AliasTable
+
 
 @dataclass
 class Chooser:
@@ -9,13 +12,25 @@ class Chooser:
     random: bool = True
     index: int = 0
     values: list = field(default_factory=list)
+    # Relative probability of every value being chosen. Values are chosen uniformly when left out
+    weights: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        self.table = None if self.weights is None else AliasTable(self.weights)
 
     def choose(self):
-        if self.random:
-            return self.rng.choice(self.values)
-        value = self.values[self.index % len(self.values)]
-        self.index += 1
-        return value
+        return self.choose_many(1)[0]
+
+    def choose_many(self, count: int) -> list:
+        if not self.random:
+            picks = [self.values[(self.index + i) % len(self.values)] for i in range(count)]
+            self.index += count
+            return picks
+        if self.table is None:
+            indexes = self.rng.integers(len(self.values), size=count)
+        else:
+            indexes = self.table.sample(self.rng, count)
+        return [self.values[ix] for ix in indexes]
 
     def reset(self):
         self.index = 0
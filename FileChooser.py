@@ -1,16 +1,92 @@
-from dataclasses import dataclass
+import pathlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
 import numpy as np
 
+from helpers import AliasTable
+
+# Picks of files that were already picked are rejected with a probability that grows with their number of uses. The
+# number of attempts is bounded, so a pick always terminates even when every file has been used many times
+MAX_REPEAT_ATTEMPTS = 32
+MAX_CANDIDATE_INDEXES = 16
+
+
+@dataclass
+class CandidateIndex:
+    values: list
+    table: Optional[AliasTable] = None
+
+
+# A chooser is created for every sequence, so indexes are built once per list of candidates and shared by every
+# chooser in the process
+_candidate_indexes: OrderedDict = OrderedDict()
+
+
+def file_weights(values: list, weighting: str, durations: Optional[dict[str, float]] = None) -> Optional[np.ndarray]:
+    if weighting == "duration":
+        durations = durations or {}
+        weights = np.array([durations.get(str(value), np.nan) for value in values], dtype=np.float64)
+        # Files missing from the manifest are weighted like an average file
+        return np.where(np.isnan(weights), np.nanmean(weights) if np.isfinite(weights).any() else 1, weights)
+    if weighting == "folder":
+        # Every folder is picked equally often, however many files it holds
+        _, folder_ids, folder_sizes = np.unique([str(pathlib.Path(value).parent) for value in values],
+                                                return_inverse=True, return_counts=True)
+        return 1 / folder_sizes[folder_ids]
+    return None
+
+
+def get_candidate_index(values: list, weighting: str, durations: Optional[dict[str, float]] = None) -> CandidateIndex:
+    key = (id(values), weighting)
+    index = _candidate_indexes.get(key)
+    if index is not None and index.values is values:
+        _candidate_indexes.move_to_end(key)
+        return index
+    weights = file_weights(values, weighting, durations)
+    index = CandidateIndex(values, None if weights is None else AliasTable(weights))
+    _candidate_indexes[key] = index
+    while len(_candidate_indexes) > MAX_CANDIDATE_INDEXES:
+        _candidate_indexes.popitem(last=False)
+    return index
+
 
 @dataclass
 class FileChooser:
     rng: np.random.Generator
     file_selection_method: str = "random"
     index: int = 0
+    weighting: str = "uniform"
+    # Lengths in seconds of the files, used when weighting by duration
+    durations: Optional[dict[str, float]] = None
+    # Makes files that were already picked by this chooser less likely to be picked again
+    avoid_repeats: bool = False
+    _uses: dict = field(default_factory=dict)
 
     def choose(self, values: list) -> str:
-        if self.file_selection_method == "random":
-            return self.rng.choice(values)
-        value = values[self.index % len(values)]
-        self.index += 1
-        return value
+        return self.choose_many(values, 1)[0]
+
+    def choose_many(self, values: list, count: int) -> list:
+        if self.file_selection_method != "random":
+            picks = [values[(self.index + i) % len(values)] for i in range(count)]
+            self.index += count
+            return picks
+        candidates = get_candidate_index(values, self.weighting, self.durations)
+        if not self.avoid_repeats:
+            return [values[ix] for ix in self.sample(candidates, count)]
+        uses = self._uses.setdefault(id(values), np.zeros(len(values), dtype=np.int64))
+        picks = []
+        for _ in range(count):
+            for _ in range(MAX_REPEAT_ATTEMPTS):
+                ix = self.sample(candidates)
+                if self.rng.random() * (1 + uses[ix]) < 1:
+                    break
+            uses[ix] += 1
+            picks.append(values[ix])
+        return picks
+
+    def sample(self, candidates: CandidateIndex, size: Optional[int] = None):
+        if candidates.table is None:
+            return self.rng.integers(len(candidates.values), size=size)
+        return candidates.table.sample(self.rng, size)
@@ -0,0 +1,41 @@
+import pathlib
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class GenerationSettings:
+    source_files: List[pathlib.Path]
+    substitution_files: List[pathlib.Path]
+    # Lengths in seconds of the source and substitution files, as recorded in the library manifest
+    file_durations: dict[str, float] = field(default_factory=dict)
+    output: pathlib.Path = pathlib.Path(".")
+    output_prefix: str = "output"
+    generation_depth: int = 1
+    min_duration: int = 4
+    max_duration: int = 7
+    trim: bool = False
+    one_shot_mode: str = "false"
+    strategy: str = "ShuffleByDuration"
+    onset_method: str = "specflux"
+    onset_engine: str = "aubio"
+    file_selection_method: str = "random"
+    file_weighting: str = "uniform"
+    avoid_repeats: bool = False
+    options: dict = field(default_factory=lambda: {"normalize_durations": False, "event_counts": [1]})
+    cache_dir: Optional[pathlib.Path] = None
+    cache_size: int = 256
+    pcm_cache_dir: Optional[pathlib.Path] = None
+    pcm_cache_size: int = 0
+    index_file: Optional[pathlib.Path] = None
+    bit_depth: int = 16
+    tail_ms: int = 0
+    fade_shape: str = "power"
+    # Sample rate everything is converted to and rendered at. None keeps the rate of each source clip
+    sample_rate: Optional[int] = None
+    variations_per_source: int = 1
+    render_chunk_seconds: int = 0
+    log_level: int = 2
+    profile: bool = False
+    # Silences progress messages, like the file chosen for every sequence
+    quiet: bool = False
@@ -1,6 +1,22 @@
-from dataclasses import dataclass
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Optional
 
-import click
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Spans that together make up the work done for one sequence, without nesting
+PIPELINE_STAGES = ["source", "substitution", "strategy", "fade", "write"]
 
 
 @dataclass
@@ -9,7 +25,155 @@ class Logger:
     WARNING: int = 1
     ERROR: int = 2
     logLevel: int = 2
-        
+    profile: bool = False
+    # Silences the progress messages of echo, for use as a library
+    quiet: bool = False
+    spans: list = field(default_factory=list)
+    # The sequence being worked on is tracked per thread, so that pipelined stages are attributed correctly
+    _context: threading.local = field(default_factory=threading.local, repr=False)
+
+    @property
+    def sequence(self) -> Optional[int]:
+        return getattr(self._context, "sequence", None)
+
+    @sequence.setter
+    def sequence(self, sequence: Optional[int]):
+        self._context.sequence = sequence
+
+    @contextlib.contextmanager
+    def sequence_context(self, sequence: int):
+        previous_sequence = self.sequence
+        self.sequence = sequence
+        try:
+            yield
+        finally:
+            self.sequence = previous_sequence
+
     def log(self, message: str, level: int = 0):
         if level >= self.logLevel:
-            click.echo(message)
\ No newline at end of file
+            print(message, flush=True)
+
+    def echo(self, message: str):
+        if not self.quiet:
+            print(message, flush=True)
+
+    @contextlib.contextmanager
+    def span(self, name: str, samples: int = 0):
+        # Yields a dict that can be updated with details only known once the work is done, like the sample count
+        details = {"samples": samples}
+        if not self.profile:
+            yield details
+            return
+        memory_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield details
+        finally:
+            duration = time.perf_counter() - start
+            memory_after = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            self.spans.append({
+                "name": name,
+                "sequence": self.sequence,
+                "start": started_at,
+                "duration": duration,
+                "memory_delta": memory_after - memory_before,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                **details
+            })
+
+    @contextlib.contextmanager
+    def sequence_span(self, sequence: int):
+        # Tracks peak memory for a whole sequence, on top of the timing of the span itself
+        if self.profile and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        with self.sequence_context(sequence):
+            with self.span("sequence") as details:
+                try:
+                    yield
+                finally:
+                    if self.profile:
+                        details["peak_traced_memory"] = tracemalloc.get_traced_memory()[1] \
+                            if tracemalloc.is_tracing() else 0
+                        details["peak_rss"] = peak_rss()
+
+    def activate(self):
+        global active_logger
+        active_logger = self
+        if self.profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def report(self) -> str:
+        lines = []
+        sequences = [span for span in self.spans if span["name"] == "sequence"]
+        for sequence_span in sorted(sequences, key=lambda span: span["sequence"]):
+            lines.append(f"Sequence {sequence_span['sequence']}: {sequence_span['duration']:.3f}s, "
+                         f"peak traced memory {sequence_span.get('peak_traced_memory', 0) / 1024 / 1024:.1f} MB, "
+                         f"peak RSS {sequence_span.get('peak_rss', 0) / 1024 / 1024:.1f} MB")
+        if not sequences:
+            # Pipelined runs overlap sequences, so only the time spent in each sequence's own stages is reported
+            busy_times = {}
+            for span in self.spans:
+                if span["sequence"] is not None and span["name"] in PIPELINE_STAGES:
+                    busy_times[span["sequence"]] = busy_times.get(span["sequence"], 0) + span["duration"]
+            for sequence, busy_time in sorted(busy_times.items()):
+                lines.append(f"Sequence {sequence}: {busy_time:.3f}s in stages")
+        lines.append(f"Peak RSS {peak_rss() / 1024 / 1024:.1f} MB")
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span["name"], {"count": 0, "duration": 0.0, "samples": 0, "memory": 0})
+            total["count"] += 1
+            total["duration"] += span["duration"]
+            total["samples"] += span["samples"]
+            total["memory"] += span["memory_delta"]
+        lines.append(f"{'Stage':<20}{'Count':>8}{'Total (s)':>12}{'Mean (ms)':>12}{'Samples/s':>14}{'Mem (MB)':>10}")
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]["duration"]):
+            throughput = total["samples"] / total["duration"] if total["samples"] and total["duration"] else 0
+            lines.append(f"{name:<20}{total['count']:>8}{total['duration']:>12.3f}"
+                         f"{total['duration'] / total['count'] * 1000:>12.2f}{throughput:>14.0f}"
+                         f"{total['memory'] / 1024 / 1024:>10.1f}")
+        return "\n".join(lines)
+
+    def write_trace(self, filename: str):
+        # Files ending in .jsonl get one span per line, anything else is written in the Chrome trace event format
+        with open(filename, "w", encoding="utf-8") as f:
+            if filename.endswith(".jsonl"):
+                for span in self.spans:
+                    f.write(json.dumps(span) + "\n")
+                return
+            json.dump({"traceEvents": [{
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": {name: value for name, value in span.items()
+                         if name not in ["name", "start", "duration", "pid", "tid"]}
+            } for span in self.spans]}, f)
+
+
+def peak_rss() -> int:
+    if resource is None:
+        return 0
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+active_logger = Logger()
+
+
+def span(name: str, samples: int = 0):
+    return active_logger.span(name, samples)
+
+
+def profiled(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with active_logger.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
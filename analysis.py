@@ -0,0 +1,236 @@
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+from pedalboard_native.io import AudioFile
+
+import audio_utils
+import features
+import onsets as numpy_onsets
+from AudioFilePool import shared_pool
+from Logger import profiled
+from analysis_cache import AnalysisCache
+
+ONSET_WINDOW_SIZE = 512  # fft size
+ONSET_HOP_SIZE = ONSET_WINDOW_SIZE // 2
+# Number of samples read from a file per call during analysis, rounded down to a multiple of the hop size
+ANALYSIS_BLOCK_SIZE = 44100
+PITCH_METHOD = "yinfast"  # Same estimates as yin, computed with FFTs, which is about 25 times faster
+PITCH_WINDOW_SIZE = 2048
+PITCH_TOLERANCE = 0.8
+# Bump whenever the contents of an analysis change, so that stale cache entries are not picked up
+ANALYSIS_VERSION = 5
+# Files whose analysis fails with one of these are left out of indexes
+ANALYSIS_ERRORS = (OSError, RuntimeError, ValueError)
+
+
+def stream_onsets(file: AudioFile,
+                  num_samples: int,
+                  aubio_method: str,
+                  win_s: int = ONSET_WINDOW_SIZE,
+                  hop_s: int = ONSET_HOP_SIZE,
+                  block_size: int = ANALYSIS_BLOCK_SIZE,
+                  on_hop: Optional[Callable[[np.ndarray], None]] = None) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Reads num_samples from the current position of file in large blocks and runs onset detection on hop sized
+    views of a mono downmix of each block. Yields the onsets found in a block, relative to the start of the stream,
+    with the (channels, frames) block."""
+    # aubio is imported on first use, so that runs whose analyses are all cached never load it
+    import aubio
+    onset_detector = aubio.onset(aubio_method, samplerate=file.samplerate, hop_size=hop_s, buf_size=win_s)
+    block_size = max(hop_s, block_size // hop_s * hop_s)
+    samples_read = 0
+    while samples_read < num_samples:
+        block = file.read(min(block_size, num_samples - samples_read))
+        if block.shape[-1] == 0:
+            break
+        samples_read += block.shape[-1]
+        mono = np.ascontiguousarray(audio_utils.downmix(block), dtype=np.float32)
+        onsets = []
+        # Incomplete hops are only possible at the end of the stream and are not analysed
+        for hop_start in range(0, len(mono) - hop_s + 1, hop_s):
+            hop = mono[hop_start:hop_start + hop_s]
+            if onset_detector(hop):
+                onsets.append(onset_detector.get_last())
+            if on_hop is not None:
+                on_hop(hop)
+        yield np.array(onsets, dtype=np.int64), block
+
+
+def read_and_detect_onsets(file: AudioFile,
+                           num_samples: int,
+                           aubio_method: str,
+                           win_s: int = ONSET_WINDOW_SIZE,
+                           hop_s: int = ONSET_HOP_SIZE,
+                           on_hop: Optional[Callable[[np.ndarray], None]] = None,
+                           downmix: bool = False,
+                           onset_engine: str = "aubio") -> tuple[np.ndarray, np.ndarray]:
+    # Returns the samples as a (channels, frames) array, with a single channel if they are downmixed
+    if onset_engine == "numpy":
+        # The whole range is decoded at once and onsets are detected in a single vectorized pass over it
+        samples = file.read(num_samples)
+        mono = read_hops(samples, hop_s, on_hop)
+        detected = numpy_onsets.detect_onsets(mono, int(file.samplerate), aubio_method, win_s, hop_s)
+        return (mono[np.newaxis] if downmix else samples), detected
+    samples = np.empty((1 if downmix else file.num_channels, num_samples), dtype=np.float32)
+    onsets = [np.zeros(0, dtype=np.int64)]
+    samples_read = 0
+    for block_onsets, block in stream_onsets(file, num_samples, aubio_method, win_s, hop_s, on_hop=on_hop):
+        samples[:, samples_read:samples_read + block.shape[-1]] = audio_utils.downmix(block) if downmix else block
+        samples_read += block.shape[-1]
+        onsets.append(block_onsets)
+    return samples[:, :samples_read], np.concatenate(onsets)
+
+
+def read_hops(samples: np.ndarray, hop_s: int, on_hop: Optional[Callable[[np.ndarray], None]] = None) -> np.ndarray:
+    # Mono downmix of decoded samples, with on_hop called on every complete hop like stream_onsets does
+    mono = np.ascontiguousarray(audio_utils.downmix(samples), dtype=np.float32)
+    if on_hop is not None:
+        for hop_start in range(0, len(mono) - hop_s + 1, hop_s):
+            on_hop(mono[hop_start:hop_start + hop_s])
+    return mono
+
+
+def track_pitch(samplerate: int,
+                win_s: int = ONSET_WINDOW_SIZE,
+                hop_s: int = ONSET_HOP_SIZE) -> tuple[Callable[[np.ndarray], None], list, list]:
+    # Returns an on_hop callback for stream_onsets, so pitch is estimated from the blocks decoded for onset detection,
+    # along with the lists it fills with the pitch (in midi notes) and confidence of every hop
+    import aubio
+    pitch_detector = aubio.pitch(PITCH_METHOD, max(PITCH_WINDOW_SIZE, win_s), hop_s, samplerate)
+    pitch_detector.set_unit("midi")
+    pitch_detector.set_tolerance(PITCH_TOLERANCE)
+    hop_pitches = []
+    hop_confidences = []
+
+    def detect_pitch(hop: np.ndarray):
+        hop_pitches.append(pitch_detector(hop)[0])
+        hop_confidences.append(pitch_detector.get_confidence())
+
+    return detect_pitch, hop_pitches, hop_confidences
+
+
+def estimate_pitch(samples: np.ndarray, samplerate: int, hop_s: int = ONSET_HOP_SIZE) -> float:
+    # Pitch (in midi notes) of a single event, like a one shot, given its (channels, frames) samples. 0 if no hop of
+    # it has a confident estimate
+    detect_pitch, hop_pitches, hop_confidences = track_pitch(samplerate, hop_s=hop_s)
+    read_hops(samples, hop_s, detect_pitch)
+    return float(features.event_pitch(np.array(hop_pitches, dtype=np.float32),
+                                      np.array(hop_confidences, dtype=np.float32),
+                                      np.zeros(1, dtype=np.int64), hop_s)[0])
+
+
+def summarise_analysis(samples: np.ndarray,
+                       onsets: np.ndarray,
+                       samplerate: int,
+                       hop_pitches: list,
+                       hop_confidences: list,
+                       hop_s: int) -> dict[str, np.ndarray]:
+    onsets = np.unique(np.append(onsets, 0))
+    onsets = onsets[onsets < max(len(samples), 1)]
+    return {
+        "onsets": onsets,
+        "pitch": features.event_pitch(np.array(hop_pitches, dtype=np.float32),
+                                      np.array(hop_confidences, dtype=np.float32),
+                                      onsets, hop_s),
+        **features.event_descriptors(samples, onsets, samplerate),
+        "frames": np.array(len(samples), dtype=np.int64),
+        "samplerate": np.array(samplerate, dtype=np.int64)
+    }
+
+
+@profiled("file_analysis")
+def analyse_audio_file(filename: str,
+                       aubio_method: str,
+                       win_s: int = ONSET_WINDOW_SIZE,
+                       hop_s: int = ONSET_HOP_SIZE,
+                       onset_engine: str = "aubio") -> dict[str, np.ndarray]:
+    with shared_pool.open_reader(filename) as file:
+        samplerate = file.samplerate
+        detect_pitch, hop_pitches, hop_confidences = track_pitch(samplerate, win_s, hop_s)
+        samples, onsets = read_and_detect_onsets(file, file.frames, aubio_method, win_s, hop_s, detect_pitch,
+                                                 downmix=True, onset_engine=onset_engine)
+    return summarise_analysis(samples[0], onsets, samplerate, hop_pitches, hop_confidences, hop_s)
+
+
+@profiled("file_analysis")
+def analyse_audio_files(filenames: List[str],
+                        aubio_method: str,
+                        win_s: int = ONSET_WINDOW_SIZE,
+                        hop_s: int = ONSET_HOP_SIZE,
+                        onset_engine: str = "aubio") -> List[Optional[dict[str, np.ndarray]]]:
+    """Analyses every file like analyse_audio_file. With the numpy engine, the onsets of all files of the same sample
+    rate are detected in one batch. Files that cannot be analysed are None"""
+    if onset_engine != "numpy":
+        analyses = []
+        for filename in filenames:
+            try:
+                analyses.append(analyse_audio_file(filename, aubio_method, win_s, hop_s))
+            except ANALYSIS_ERRORS:
+                analyses.append(None)
+        return analyses
+    numpy_onsets.numpy_onset_method(aubio_method)
+    decoded = []
+    for filename in filenames:
+        try:
+            with shared_pool.open_reader(filename) as file:
+                samplerate = int(file.samplerate)
+                detect_pitch, hop_pitches, hop_confidences = track_pitch(samplerate, win_s, hop_s)
+                decoded.append((read_hops(file.read(file.frames), hop_s, detect_pitch), samplerate, hop_pitches,
+                                hop_confidences))
+        except ANALYSIS_ERRORS:
+            decoded.append(None)
+    detected = {}
+    for samplerate in {file[1] for file in decoded if file is not None}:
+        batch = [i for i, file in enumerate(decoded) if file is not None and file[1] == samplerate]
+        batch_onsets = numpy_onsets.detect_onsets_batch([decoded[i][0] for i in batch], samplerate, aubio_method,
+                                                        win_s, hop_s)
+        detected.update(zip(batch, batch_onsets))
+    return [None if file is None else summarise_analysis(file[0], detected[i], file[1], file[2], file[3], hop_s)
+            for i, file in enumerate(decoded)]
+
+
+def analysis_key(filename: str, aubio_method: str, win_s: int, hop_s: int, onset_engine: str) -> str:
+    # Entries of the aubio engine keep the keys they had before there was a choice of engine
+    engine = [] if onset_engine == "aubio" else [onset_engine]
+    return AnalysisCache.key(filename, aubio_method, win_s, hop_s, ANALYSIS_VERSION, *engine)
+
+
+def get_file_analysis(filename: str,
+                      aubio_method: str,
+                      analysis_cache: Optional[AnalysisCache],
+                      win_s: int = ONSET_WINDOW_SIZE,
+                      hop_s: int = ONSET_HOP_SIZE,
+                      onset_engine: str = "aubio") -> dict[str, np.ndarray]:
+    if analysis_cache is None:
+        return analyse_audio_file(filename, aubio_method, win_s, hop_s, onset_engine)
+    key = analysis_key(filename, aubio_method, win_s, hop_s, onset_engine)
+    analysis = analysis_cache.load(key)
+    if analysis is None:
+        analysis = analyse_audio_file(filename, aubio_method, win_s, hop_s, onset_engine)
+        analysis_cache.store(key, analysis)
+    return analysis
+
+
+def get_file_analyses(filenames: List[str],
+                      aubio_method: str,
+                      analysis_cache: Optional[AnalysisCache],
+                      win_s: int = ONSET_WINDOW_SIZE,
+                      hop_s: int = ONSET_HOP_SIZE,
+                      onset_engine: str = "aubio") -> List[Optional[dict[str, np.ndarray]]]:
+    # Like get_file_analysis for many files, where the files missing from the cache are analysed together
+    if analysis_cache is None:
+        return analyse_audio_files(filenames, aubio_method, win_s, hop_s, onset_engine)
+    keys = []
+    analyses = []
+    for filename in filenames:
+        try:
+            keys.append(analysis_key(filename, aubio_method, win_s, hop_s, onset_engine))
+        except OSError:
+            keys.append(None)
+        analyses.append(None if keys[-1] is None else analysis_cache.load(keys[-1]))
+    missing = [i for i, key in enumerate(keys) if key is not None and analyses[i] is None]
+    for i, analysis in zip(missing, analyse_audio_files([filenames[i] for i in missing], aubio_method, win_s, hop_s,
+                                                        onset_engine)):
+        analyses[i] = analysis
+        if analysis is not None:
+            analysis_cache.store(keys[i], analysis)
+    return analyses
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import pathlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+CACHE_FILE_SUFFIX = ".npz"
+# Eviction frees space down to this share of the maximum size, so that the next entries fit without another scan
+EVICTION_TARGET_FRACTION = 0.9
+
+
+@dataclass
+class AnalysisCache:
+    cache_dir: pathlib.Path
+    max_bytes: int = 256 * 1024 * 1024
+    # Most recently used entries are also kept in memory, so long running processes do not reread them
+    max_memory_entries: int = 256
+    _memory: OrderedDict = field(default_factory=OrderedDict)
+    # Size of the cache directory as of the last scan plus everything stored since, so the directory is only scanned
+    # again once it may have outgrown max_bytes. Entries stored by other processes are counted by that scan
+    _total_bytes: Optional[int] = None
+
+    def __post_init__(self):
+        self.cache_dir = pathlib.Path(self.cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(filename: str, *settings) -> str:
+        path = pathlib.Path(filename).resolve()
+        stat = path.stat()
+        key_source = "|".join(str(part) for part in [path, stat.st_size, stat.st_mtime_ns, *settings])
+        return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+    def load(self, key: str) -> Optional[dict[str, np.ndarray]]:
+        result = self._memory.get(key)
+        if result is not None:
+            self._memory.move_to_end(key)
+            return result
+        entry = self.cache_dir / f"{key}{CACHE_FILE_SUFFIX}"
+        try:
+            with np.load(entry) as data:
+                result = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        # Touching the entry keeps the mtime usable as an LRU timestamp
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        self.remember(key, result)
+        return result
+
+    def remember(self, key: str, arrays: dict[str, np.ndarray]):
+        if self.max_memory_entries <= 0:
+            return
+        self._memory[key] = arrays
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def store(self, key: str, arrays: dict[str, np.ndarray]):
+        entry = self.cache_dir / f"{key}{CACHE_FILE_SUFFIX}"
+        # Write to a temporary file first so that concurrent readers never see a partially written entry
+        temp_entry = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+        with open(temp_entry, "wb") as f:
+            np.savez(f, **arrays)
+            entry_bytes = f.tell()
+        os.replace(temp_entry, entry)
+        self.remember(key, arrays)
+        if self._total_bytes is not None:
+            self._total_bytes += entry_bytes
+        if self._total_bytes is None or self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        self._total_bytes = evict_least_recently_used(self.cache_dir, CACHE_FILE_SUFFIX,
+                                                      int(self.max_bytes * EVICTION_TARGET_FRACTION))
+
+
+def evict_least_recently_used(cache_dir: pathlib.Path,
+                              suffix: str,
+                              max_bytes: int,
+                              keep: Optional[pathlib.Path] = None) -> int:
+    # Entries are ordered by mtime, which loading an entry updates. The entry to keep is one that is about to be read.
+    # Returns the size of the entries that are left
+    entries = []
+    total_bytes = 0
+    for entry in cache_dir.glob(f"*{suffix}"):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+        total_bytes += stat.st_size
+    entries.sort()
+    for _, size, entry in entries:
+        if total_bytes <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        try:
+            entry.unlink()
+        except OSError:
+            continue
+        total_bytes -= size
+    return total_bytes
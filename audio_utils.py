@@ -1,5 +1,53 @@
+import functools
 import math
+from typing import Callable, Optional
+
 import numpy as np
 
-default_fade_out_curve = 1 - np.power(np.arange(0.0, 1.0, 1 / math.floor(20 * 44.1), dtype=float), 8)
-default_fade_in_curve = np.linspace(0.0, 1.0, 88)
+
+@functools.lru_cache(maxsize=1)
+def get_resample_poly() -> Optional[Callable]:
+    # scipy.signal takes longer to import than everything else together, so it is only imported once audio is resampled
+    try:
+        from scipy.signal import resample_poly
+    except ImportError:
+        return None
+    return resample_poly
+
+
+def downmix(samples: np.ndarray) -> np.ndarray:
+    # Mono mix of a (channels, frames) array, used wherever only one signal is needed, like onset detection
+    if samples.shape[0] == 1:
+        return samples[0]
+    return samples.mean(axis=0, dtype=np.float32)
+
+
+def conform_channels(samples: np.ndarray, num_channels: int) -> np.ndarray:
+    if samples.shape[0] == num_channels:
+        return samples
+    if num_channels == 1:
+        return downmix(samples)[np.newaxis, :]
+    if samples.shape[0] == 1:
+        return np.broadcast_to(samples, (num_channels, samples.shape[1]))
+    return samples[np.arange(num_channels) % samples.shape[0]]
+
+
+def resampled_length(num_frames: int, from_rate: int, to_rate: int) -> int:
+    return int(math.ceil(num_frames * to_rate / from_rate))
+
+
+def resample(samples: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    # Resamples every channel of a (channels, frames) array at once, with a polyphase filter if scipy is available and
+    # linear interpolation otherwise
+    from_rate, to_rate = int(from_rate), int(to_rate)
+    if from_rate == to_rate or samples.shape[-1] == 0:
+        return samples
+    resample_poly = get_resample_poly()
+    if resample_poly is not None:
+        divisor = math.gcd(from_rate, to_rate)
+        return resample_poly(samples, to_rate // divisor, from_rate // divisor, axis=-1).astype(np.float32)
+    positions = np.arange(resampled_length(samples.shape[-1], from_rate, to_rate)) * (from_rate / to_rate)
+    left = np.minimum(positions.astype(np.int64), samples.shape[-1] - 1)
+    right = np.minimum(left + 1, samples.shape[-1] - 1)
+    fractions = (positions - left).astype(np.float32)
+    return (samples[..., left] * (1 - fractions) + samples[..., right] * fractions).astype(np.float32)
@@ -0,0 +1,152 @@
+import contextlib
+import json
+import os
+import pathlib
+import socket
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+# A claim that has not been completed after this long is assumed to belong to a worker that died, and is handed out
+# again
+CLAIM_TIMEOUT_SECONDS = 3600
+# How long a worker waits for another worker's transaction to finish before giving up
+LOCK_TIMEOUT_SECONDS = 60
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    sequence INTEGER PRIMARY KEY,
+    seed TEXT NOT NULL,
+    source_file TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed_at REAL,
+    completed_at REAL,
+    outputs TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, sequence);
+"""
+
+
+def seed_to_json(seed_sequence: np.random.SeedSequence) -> str:
+    # Entropy can be larger than a 64 bit integer, so it is stored as a string
+    return json.dumps({"entropy": str(seed_sequence.entropy), "spawn_key": list(seed_sequence.spawn_key),
+                       "pool_size": seed_sequence.pool_size})
+
+
+def seed_from_json(value: str) -> np.random.SeedSequence:
+    seed = json.loads(value)
+    return np.random.SeedSequence(int(seed["entropy"]), spawn_key=tuple(seed["spawn_key"]),
+                                  pool_size=seed["pool_size"])
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class BatchError(ValueError):
+    """Raised when a run does not match the batch its manifest was created for"""
+
+
+@dataclass
+class BatchManifest:
+    """SQLite file listing every sequence of a batch with its seed, source file and parameters. Workers on any number
+    of machines claim sequences from it one at a time and record the outputs of every finished one, so interrupted
+    batches are resumed where they stopped"""
+    path: pathlib.Path
+    worker: str = field(default_factory=worker_id)
+
+    def __post_init__(self):
+        self.path = pathlib.Path(self.path)
+        # Transactions are started explicitly, so that claiming a job is a single atomic read and write
+        self.connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def settings(self) -> Optional[dict]:
+        row = self.connection.execute("SELECT value FROM batch WHERE key = 'settings'").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def create(self, settings: dict, jobs: list[tuple[int, np.random.SeedSequence, str, dict]]) -> dict:
+        # Several workers may start on a new batch at once. The first one writes the jobs, the others find them and
+        # get the settings the batch was created with
+        with self.transaction():
+            existing = self.settings()
+            if existing is not None:
+                return existing
+            self.connection.execute("INSERT INTO batch (key, value) VALUES ('settings', ?)", (json.dumps(settings),))
+            self.connection.executemany(
+                "INSERT INTO jobs (sequence, seed, source_file, parameters) VALUES (?, ?, ?, ?)",
+                [(index, seed_to_json(seed_sequence), source_file, json.dumps(parameters))
+                 for index, seed_sequence, source_file, parameters in jobs])
+        return settings
+
+    def claim(self, shard: Optional[tuple[int, int]] = None) -> Optional[tuple[int, np.random.SeedSequence, str]]:
+        """Claims the first pending sequence of the shard, if any. A shard (k, N) holds the sequences whose index
+        modulo N is k - 1"""
+        shard_index, num_shards = shard or (1, 1)
+        with self.transaction():
+            self.release_stale_claims()
+            row = self.connection.execute(
+                "SELECT sequence, seed, source_file FROM jobs WHERE status = 'pending' AND sequence % ? = ? "
+                "ORDER BY sequence LIMIT 1", (num_shards, shard_index - 1)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE jobs SET status = 'claimed', worker = ?, claimed_at = ? WHERE sequence = ?",
+                                    (self.worker, time.time(), row[0]))
+        return row[0], seed_from_json(row[1]), row[2]
+
+    def complete(self, sequence_index: int, outputs: list[pathlib.Path]):
+        with self.transaction():
+            self.connection.execute("UPDATE jobs SET status = 'done', completed_at = ?, outputs = ? WHERE sequence = ?",
+                                    (time.time(), json.dumps([str(output) for output in outputs]), sequence_index))
+
+    def release(self, sequence_index: int):
+        with self.transaction():
+            self.connection.execute("UPDATE jobs SET status = 'pending', worker = NULL, claimed_at = NULL "
+                                    "WHERE sequence = ? AND status = 'claimed'", (sequence_index,))
+
+    def release_stale_claims(self):
+        # Claims of workers on this machine that are no longer running are released right away, those of other
+        # machines once they time out
+        host = self.worker.rpartition(":")[0]
+        for sequence_index, worker in self.connection.execute(
+                "SELECT sequence, worker FROM jobs WHERE status = 'claimed'").fetchall():
+            worker_host, _, pid = worker.rpartition(":")
+            if worker_host == host and worker != self.worker and pid.isdigit() and not is_running(int(pid)):
+                self.connection.execute("UPDATE jobs SET status = 'pending' WHERE sequence = ?", (sequence_index,))
+        self.connection.execute("UPDATE jobs SET status = 'pending' WHERE status = 'claimed' AND claimed_at < ?",
+                                (time.time() - CLAIM_TIMEOUT_SECONDS,))
+
+    def progress(self) -> dict[str, int]:
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never read the same pending job
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
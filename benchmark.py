@@ -0,0 +1,354 @@
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+import aubio
+import click
+import numpy as np
+from pedalboard_native.io import AudioFile
+
+import analysis
+import audio_utils
+import generation
+import onsets
+import strategies
+from AudioClip import AudioClip
+from AudioFilePool import shared_pool
+from FileChooser import FileChooser
+from GenerationSettings import GenerationSettings
+from library_manifest import get_audio_files, scan_audio_files
+from render import write_audio_clip
+
+CORPUS_KINDS = ["clicks", "noise_bursts", "tones"]
+CORPUS_SAMPLE_RATES = [44100, 48000]
+CORPUS_LENGTHS_SECONDS = [1, 4, 20]
+BENCHMARK_STRATEGIES = ["ShuffleByDuration", "ShuffleByPitch", "ShuffleByTimbre", "Interleave", "InterleavedShuffle",
+                        "InterleaveInPlace"]
+ONE_SHOT_MODES = ["false", "true", "long"]
+# Onsets of the numpy engine within this distance of an aubio onset count as the same onset
+ONSET_MATCH_TOLERANCE_SECONDS = 0.05
+# Fields of a result that are measurements rather than parameters of the stage
+METRIC_FIELDS = ["samples_per_second", "f_measure"]
+# Started in a fresh interpreter each, so that the time includes every import
+STARTUP_COMMANDS = {
+    "import_main": ["-c", "import main"],
+    "help": ["main.py", "--help"],
+    "import_generation": ["-c", "import generation"]
+}
+# Modules the command line must not import before a command needs them
+LAZY_MODULES = ["numpy", "aubio", "scipy", "pedalboard_native"]
+PACKAGE_DIR = pathlib.Path(__file__).parent
+
+
+def synthesize(kind: str, sample_rate: int, seconds: float, rng: np.random.Generator) -> np.ndarray:
+    num_samples = int(sample_rate * seconds)
+    time_axis = np.arange(num_samples) / sample_rate
+    if kind == "tones":
+        frequency = rng.uniform(60, 1000)
+        envelope = np.minimum(1, np.minimum(time_axis, time_axis[::-1]) * 50)
+        return (0.5 * envelope * np.sin(2 * np.pi * frequency * time_axis)).astype(np.float32)
+    result = 0.005 * rng.standard_normal(num_samples)
+    step = int(sample_rate * 60 / rng.uniform(90, 160) / 2)
+    burst_length = min(int(sample_rate * 0.05), num_samples)
+    decay = np.exp(-np.arange(burst_length) / (burst_length / 6))
+    for start in range(0, num_samples - burst_length, step):
+        if kind == "clicks":
+            burst = np.sin(2 * np.pi * rng.uniform(100, 4000) * np.arange(burst_length) / sample_rate)
+        else:
+            burst = rng.standard_normal(burst_length)
+        result[start:start + burst_length] += rng.uniform(0.2, 0.9) * decay * burst
+    return np.clip(result, -1, 1).astype(np.float32)
+
+
+def build_corpus(directory: pathlib.Path, num_files: int, seed: int) -> List[pathlib.Path]:
+    # The corpus only depends on the seed and the number of files, so results are comparable across commits
+    rng = np.random.default_rng(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(num_files):
+        kind = CORPUS_KINDS[i % len(CORPUS_KINDS)]
+        sample_rate = CORPUS_SAMPLE_RATES[(i // len(CORPUS_KINDS)) % len(CORPUS_SAMPLE_RATES)]
+        seconds = CORPUS_LENGTHS_SECONDS[(i // 2) % len(CORPUS_LENGTHS_SECONDS)]
+        path = directory / f"{kind}-{i}-{sample_rate}-{seconds}s.wav"
+        with AudioFile(str(path), "w", samplerate=sample_rate, num_channels=1) as f:
+            f.write(synthesize(kind, sample_rate, seconds, rng))
+        files.append(path)
+    return files
+
+
+def time_stage(stage: Callable[[], object],
+               repeats: int,
+               setup: Optional[Callable[[], None]] = None) -> dict[str, float]:
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        stage()
+        timings.append(time.perf_counter() - start)
+    return {"min_seconds": min(timings), "median_seconds": statistics.median(timings)}
+
+
+def aubio_onsets(samples: np.ndarray, samplerate: int, method: str) -> np.ndarray:
+    # Same hop by hop detection as analysis.stream_onsets, on samples that are already decoded
+    detector = aubio.onset(method, samplerate=samplerate, hop_size=analysis.ONSET_HOP_SIZE,
+                           buf_size=analysis.ONSET_WINDOW_SIZE)
+    detected = []
+    for hop_start in range(0, len(samples) - analysis.ONSET_HOP_SIZE + 1, analysis.ONSET_HOP_SIZE):
+        if detector(samples[hop_start:hop_start + analysis.ONSET_HOP_SIZE]):
+            detected.append(detector.get_last())
+    return np.array(detected, dtype=np.int64)
+
+
+def onset_f_measure(reference: np.ndarray, detected: np.ndarray, tolerance: int) -> float:
+    # Every reference onset can be matched by one detected onset. Both are sorted, so matching is greedy
+    if len(reference) == 0 and len(detected) == 0:
+        return 1.0
+    matches = 0
+    i = 0
+    for onset in detected.tolist():
+        while i < len(reference) and reference[i] < onset - tolerance:
+            i += 1
+        if i < len(reference) and reference[i] <= onset + tolerance:
+            matches += 1
+            i += 1
+    return 2 * matches / (len(reference) + len(detected))
+
+
+def benchmark_onset_engines(files: List[pathlib.Path], repeats: int, record: Callable[..., None]):
+    # Both engines analyse the same decoded mono audio, so only detection is timed. The numpy engine gets all files
+    # of a sample rate in one batch, like when indexing
+    clips = {}
+    for file in files:
+        with AudioFile(str(file)) as f:
+            clips.setdefault(int(f.samplerate), []).append(audio_utils.downmix(f.read(f.frames)))
+    total_samples = sum(len(clip) for rate_clips in clips.values() for clip in rate_clips)
+    for method in onsets.NUMPY_ONSET_METHODS:
+        def detect_aubio():
+            return [aubio_onsets(clip, rate, method) for rate, rate_clips in clips.items() for clip in rate_clips]
+
+        def detect_numpy():
+            return [detected for rate, rate_clips in clips.items()
+                    for detected in onsets.detect_onsets_batch(rate_clips, rate, method, analysis.ONSET_WINDOW_SIZE,
+                                                               analysis.ONSET_HOP_SIZE)]
+
+        rates = [rate for rate, rate_clips in clips.items() for _ in rate_clips]
+        reference = detect_aubio()
+        for engine, detect in [("aubio", detect_aubio), ("numpy", detect_numpy)]:
+            f_measure = np.mean([onset_f_measure(expected, detected, int(ONSET_MATCH_TOLERANCE_SECONDS * rate))
+                                 for expected, detected, rate in zip(reference, detect(), rates)])
+            timing = time_stage(detect, repeats)
+            record("onset_engine", timing, onset_engine=engine, onset_method=method,
+                   samples_per_second=total_samples / timing["min_seconds"], f_measure=float(f_measure))
+
+
+def eager_imports(module: str) -> List[str]:
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    imported = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                              cwd=PACKAGE_DIR).stdout.split()
+    return [name for name in LAZY_MODULES if any(module_name.split(".")[0] == name for module_name in imported)]
+
+
+def benchmark_startup(repeats: int) -> List[dict]:
+    results = []
+    for command, args in STARTUP_COMMANDS.items():
+        timing = time_stage(lambda: subprocess.run([sys.executable, *args], capture_output=True, check=True,
+                                                   cwd=PACKAGE_DIR), repeats)
+        results.append({"stage": "startup", "command": command, **timing})
+    return results
+
+
+def reset_caches():
+    shared_pool.close()
+    generation.read_library_index.cache_clear()
+    generation.load_library_index.cache_clear()
+    generation.load_timbre_index.cache_clear()
+    generation.get_analysis_cache.cache_clear()
+
+
+def benchmark_corpus(corpus_dir: pathlib.Path,
+                     output_dir: pathlib.Path,
+                     sequence_counts: List[int],
+                     depths: List[int],
+                     repeats: int,
+                     seed: int) -> List[dict]:
+    results = []
+    files = get_audio_files(corpus_dir, False)
+    long_files = [file for file in files if "20s" in file.name]
+    corpus = {"corpus_files": len(files)}
+
+    def record(stage: str, timing: dict[str, float], **params):
+        results.append({"stage": stage, **corpus, **params, **timing})
+
+    record("file_scan", time_stage(lambda: scan_audio_files(corpus_dir, get_audio_files(corpus_dir, False),
+                                                            use_manifest=False), repeats))
+
+    def decode_all():
+        for file in files:
+            with AudioFile(str(file)) as f:
+                f.read(f.frames)
+
+    total_frames = sum(info.frames for info in scan_audio_files(corpus_dir, files, use_manifest=False))
+    timing = time_stage(decode_all, repeats)
+    record("decode", timing, samples_per_second=total_frames / timing["min_seconds"])
+
+    rng = np.random.default_rng(seed)
+    source_clip = generation.get_audio_clip(str(long_files[0]), 0.25, 7, False, "specflux")
+    timing = time_stage(lambda: generation.get_audio_clip(str(long_files[0]), 0.25, 7, False, "specflux"), repeats)
+    # Without a cache, the whole file is analysed to find the onsets of the clip
+    record("onset_detection", timing, samples_per_second=shared_pool.frames(str(long_files[0])) / timing["min_seconds"])
+    benchmark_onset_engines(files, repeats, record)
+
+    for depth in depths:
+        for one_shot_mode in ONE_SHOT_MODES:
+            timing = time_stage(lambda: generation.get_substitution_clips(files, depth, 4, 7, one_shot_mode,
+                                                                          source_clip, FileChooser(rng), False),
+                                repeats, setup=reset_caches)
+            record("substitution_clips", timing, generation_depth=depth, one_shot_mode=one_shot_mode)
+
+        substitution_clips = generation.get_substitution_clips(files, depth, 4, 7, "false", source_clip,
+                                                               FileChooser(rng), False)
+        for strategy in BENCHMARK_STRATEGIES:
+            options = {"normalize_durations": False, "event_counts": [2]}
+            timing = time_stage(lambda: generation.generate_sequence(strategy, source_clip, substitution_clips,
+                                                                     options, rng=rng), repeats)
+            record("strategy", timing, generation_depth=depth, strategy=strategy)
+
+    result_clip = AudioClip(strategies.shuffle_by_duration(source_clip, [source_clip], False),
+                            source_clip.sample_rate)
+    timing = time_stage(lambda: write_audio_clip(str(output_dir / "benchmark-write"), result_clip), repeats)
+    record("write", timing)
+
+    for number_of_seqs in sequence_counts:
+        for depth in depths:
+            settings = GenerationSettings(source_files=long_files,
+                                          substitution_files=files,
+                                          output=output_dir,
+                                          output_prefix="benchmark",
+                                          generation_depth=depth)
+            seed_sequences = np.random.SeedSequence(seed).spawn(number_of_seqs)
+
+            def generate_all():
+                for i, seed_sequence in enumerate(seed_sequences):
+                    generation.generate_output(i, seed_sequence, settings)
+
+            timing = time_stage(generate_all, repeats, setup=reset_caches)
+            record("generate", timing, number_of_seqs=number_of_seqs, generation_depth=depth)
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=PACKAGE_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> List[str]:
+    def key(result: dict) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in result.items() if not name.endswith("seconds")
+                            and name not in METRIC_FIELDS))
+
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_results.get(key(result))
+        if previous is None or previous["min_seconds"] == 0:
+            continue
+        ratio = result["min_seconds"] / previous["min_seconds"]
+        if ratio > 1 + threshold:
+            regressions.append(f"{dict(key(result))}: {previous['min_seconds']:.4f}s -> "
+                               f"{result['min_seconds']:.4f}s ({ratio:.2f}x)")
+    return regressions
+
+
+@click.command()
+@click.option("--output", "-o",
+              type=click.Path(dir_okay=False, writable=True, path_type=pathlib.Path),
+              default="benchmark.json",
+              show_default=True,
+              help="JSON file to write the results to")
+@click.option("--corpus-sizes",
+              default="6,24",
+              show_default=True,
+              help="Comma separated numbers of files in the synthetic corpora")
+@click.option("--sequence-counts", "-n",
+              default="1,4",
+              show_default=True,
+              help="Comma separated numbers of sequences to generate in the full pipeline stage")
+@click.option("--generation-depths", "-d",
+              default="1,3",
+              show_default=True,
+              help="Comma separated generation depths to benchmark")
+@click.option("--repeats", "-r",
+              type=click.IntRange(1, None),
+              default=3,
+              show_default=True,
+              help="Number of times each stage is run. The fastest run is used for comparisons")
+@click.option("--seed", "-s",
+              type=int,
+              default=1234,
+              show_default=True,
+              help="Seed for the synthetic corpus and the generation runs")
+@click.option("--compare",
+              type=click.Path(exists=True, dir_okay=False, readable=True, path_type=pathlib.Path),
+              help="Earlier results to compare against. Stages that got slower than the threshold are reported")
+@click.option("--threshold",
+              type=float,
+              default=0.1,
+              show_default=True,
+              help="Relative slowdown that is reported as a regression when comparing")
+def run_benchmarks(output: pathlib.Path,
+                   corpus_sizes: str,
+                   sequence_counts: str,
+                   generation_depths: str,
+                   repeats: int,
+                   seed: int,
+                   compare: Optional[pathlib.Path],
+                   threshold: float) -> None:
+    """Time every stage of the generation pipeline on deterministic synthetic corpora."""
+    click.echo("Benchmarking startup")
+    results = benchmark_startup(repeats)
+    with tempfile.TemporaryDirectory(prefix="beatpainter-benchmark-") as temp_dir:
+        for corpus_size in [int(size) for size in corpus_sizes.split(",")]:
+            corpus_dir = pathlib.Path(temp_dir, f"corpus-{corpus_size}")
+            output_dir = pathlib.Path(temp_dir, f"output-{corpus_size}")
+            output_dir.mkdir()
+            build_corpus(corpus_dir, max(corpus_size, 6), seed)
+            click.echo(f"Benchmarking corpus of {corpus_size} files")
+            results += benchmark_corpus(corpus_dir, output_dir,
+                                        [int(count) for count in sequence_counts.split(",")],
+                                        [int(depth) for depth in generation_depths.split(",")],
+                                        repeats, seed)
+    report = {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    click.echo(f"Wrote {len(results)} results to {output}")
+    # Startup only stays fast while the command line leaves the heavy modules to the commands, whatever the timings
+    eager = eager_imports("main")
+    regressions = [f"importing main loads {', '.join(eager)}"] if eager else []
+    if compare is not None:
+        with open(compare, "r", encoding="utf-8") as f:
+            regressions += compare_results(json.load(f), report, threshold)
+    for regression in regressions:
+        click.echo(f"Regression: {regression}")
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
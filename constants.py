@@ -0,0 +1,88 @@
+import os
+import pathlib
+
+# Only the standard library is imported here, so that the command line can be built, and --help and argument errors
+# reported, without loading numpy, aubio or scipy
+
+# Files longer than this will have a random clip extracted from it
+SPLIT_THRESHOLD_IN_SECONDS = 15
+ONE_SHOT_SLICE_THRESHOLD_SECONDS = 3
+SHORTEST_ONE_SHOT_SECONDS = 0.1
+ONE_SHOT_MAX_SECONDS = 1
+MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one shot
+# Share of a library index that every variation of a shuffle strategy draws its candidates from
+LIBRARY_VARIATION_FRACTION = 0.5
+ONSET_METHODS = [
+    "default",
+    "energy",
+    "hfc",
+    "complex",
+    "phase",
+    "specdiff",
+    "kl",
+    "mkl",
+    "specflux"
+]
+ONSET_ENGINES = ["aubio", "numpy"]
+STRATEGIES = [
+    "Interleave",
+    "InterleavedShuffle",
+    "InterleaveInPlace",
+    "ShuffleByDuration",
+    "ShuffleByPitch",
+    "ShuffleByTimbre"
+]
+SHUFFLE_STRATEGIES = ["ShuffleByDuration", "ShuffleByPitch", "ShuffleByTimbre"]
+ONE_SHOT_MODES = ["long", "true", "false"]
+FILE_SELECTION_METHODS = ["random", "sequential"]
+FILE_WEIGHTINGS = ["uniform", "duration", "folder"]
+FADE_SHAPES = ["power", "linear", "equal_power"]
+OUTPUT_BIT_DEPTHS = {"16": 16, "24": 24, "32": 32}  # 32 bits is written as float
+AUDIO_FILE_PATTERNS = ["*.wav", "*.mp3", "*.aiff"]
+MANIFEST_FILENAME = ".beatpainter-manifest.json"
+DEFAULT_INDEX_FILENAME = "beatpainter-index.npz"
+# Settings a generation request may change, with the types their values are converted to
+REQUEST_SETTINGS = {
+    "strategy": str,
+    "one_shot_mode": str,
+    "generation_depth": int,
+    "min_duration": int,
+    "max_duration": int,
+    "trim": bool,
+    "variations_per_source": int,
+    "output_prefix": str,
+    "file_selection_method": str,
+    "file_weighting": str,
+    "avoid_repeats": bool,
+    "bit_depth": int,
+    "tail_ms": int,
+    "fade_shape": str,
+    "render_chunk_seconds": int,
+    "sample_rate": int
+}
+REQUEST_OPTIONS = {"normalize_durations": bool, "duration_tie_break": bool, "event_counts": list}
+REQUEST_CHOICES = {
+    "strategy": STRATEGIES,
+    "one_shot_mode": ONE_SHOT_MODES,
+    "file_selection_method": FILE_SELECTION_METHODS,
+    "file_weighting": FILE_WEIGHTINGS,
+    "fade_shape": FADE_SHAPES,
+    "bit_depth": list(OUTPUT_BIT_DEPTHS.values())
+}
+REQUEST_RANGES = {
+    "number_of_seqs": (1, 1000),
+    "generation_depth": (1, 10),
+    "min_duration": (1, SPLIT_THRESHOLD_IN_SECONDS),
+    "max_duration": (2, SPLIT_THRESHOLD_IN_SECONDS * 2),
+    "variations_per_source": (1, 1000),
+    "tail_ms": (0, 2000),
+    "render_chunk_seconds": (0, 3600),
+    "sample_rate": (8000, 192000),
+    "event_counts": (1, 15),
+    "seed": (0, 2 ** 128 - 1)
+}
+
+
+def default_cache_dir() -> pathlib.Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    return pathlib.Path(cache_home) / "beatpainter" if cache_home else pathlib.Path.home() / ".cache" / "beatpainter"
@@ -0,0 +1,127 @@
+import functools
+
+import numpy as np
+
+SPECTRAL_FRAME_SIZE = 2048
+PITCH_MIN_CONFIDENCE = 0.5
+NUM_MEL_BANDS = 26
+NUM_MFCC = 13
+# Descriptors that make up the timbre of an event, in the order they appear in a timbre vector, followed by the MFCCs
+TIMBRE_DESCRIPTORS = ["rms", "peak", "spectral_centroid", "spectral_flatness"]
+
+
+def event_lengths(onsets: np.ndarray, num_samples: int) -> np.ndarray:
+    return np.diff(np.append(onsets, num_samples))
+
+
+def event_rms(samples, onsets) -> np.ndarray:
+    samples = np.asarray(samples, dtype=np.float32)
+    onsets = np.asarray(onsets, dtype=np.int64)
+    if len(onsets) == 0 or len(samples) == 0:
+        return np.zeros(len(onsets), dtype=np.float32)
+    onsets = np.clip(onsets, 0, len(samples) - 1)
+    lengths = event_lengths(onsets, len(samples))
+    sums = np.add.reduceat(np.square(samples, dtype=np.float64), onsets)
+    rms = np.sqrt(sums / np.maximum(lengths, 1))
+    return np.where(lengths > 0, rms, 0).astype(np.float32)
+
+
+def event_pitch(hop_pitches: np.ndarray,
+                hop_confidences: np.ndarray,
+                onsets: np.ndarray,
+                hop_s: int,
+                min_confidence: float = PITCH_MIN_CONFIDENCE) -> np.ndarray:
+    # Mean of the confident pitch estimates (in midi notes) of all hops starting within each event, 0 if none
+    if len(onsets) == 0:
+        return np.zeros(0, dtype=np.float32)
+    hop_starts = np.arange(len(hop_pitches)) * hop_s
+    hop_events = np.searchsorted(onsets, hop_starts, side="right") - 1
+    confident = (hop_confidences >= min_confidence) & (hop_pitches > 0) & (hop_events >= 0)
+    sums = np.bincount(hop_events[confident], weights=hop_pitches[confident], minlength=len(onsets))
+    counts = np.bincount(hop_events[confident], minlength=len(onsets))
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0).astype(np.float32)
+
+
+def event_frames(samples: np.ndarray, onsets: np.ndarray, frame_size: int = SPECTRAL_FRAME_SIZE) -> np.ndarray:
+    # Packs the first frame_size samples of every event into an (events, frame_size) array, zero padded
+    onsets = np.asarray(onsets, dtype=np.int64)
+    lengths = np.minimum(event_lengths(onsets, len(samples)), frame_size)
+    positions = np.arange(frame_size)
+    indexes = onsets[:, np.newaxis] + positions
+    valid = positions < lengths[:, np.newaxis]
+    frames = np.zeros((len(onsets), frame_size), dtype=np.float32)
+    frames[valid] = samples[indexes[valid]]
+    return frames
+
+
+def event_peak(samples, onsets) -> np.ndarray:
+    samples = np.asarray(samples, dtype=np.float32)
+    onsets = np.asarray(onsets, dtype=np.int64)
+    if len(onsets) == 0 or len(samples) == 0:
+        return np.zeros(len(onsets), dtype=np.float32)
+    onsets = np.clip(onsets, 0, len(samples) - 1)
+    peaks = np.maximum.reduceat(np.abs(samples), onsets)
+    return np.where(event_lengths(onsets, len(samples)) > 0, peaks, 0).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=8)
+def mel_filterbank(sample_rate: int,
+                   frame_size: int = SPECTRAL_FRAME_SIZE,
+                   num_bands: int = NUM_MEL_BANDS) -> np.ndarray:
+    # Triangular filters evenly spaced on the mel scale, as a (bands, frequency bins) matrix
+    mel_points = np.linspace(0, 2595 * np.log10(1 + sample_rate / 2 / 700), num_bands + 2)
+    band_edges = 700 * (np.power(10, mel_points / 2595) - 1)
+    frequencies = np.fft.rfftfreq(frame_size, 1 / sample_rate)
+    lower, center, upper = band_edges[:-2, np.newaxis], band_edges[1:-1, np.newaxis], band_edges[2:, np.newaxis]
+    rising = (frequencies - lower) / (center - lower)
+    falling = (upper - frequencies) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=8)
+def dct_matrix(num_bands: int = NUM_MEL_BANDS, num_coefficients: int = NUM_MFCC) -> np.ndarray:
+    # Orthonormal DCT-II, as a (coefficients, bands) matrix
+    matrix = np.cos(np.pi / num_bands * (np.arange(num_bands) + 0.5) * np.arange(num_coefficients)[:, np.newaxis])
+    matrix *= np.sqrt(2 / num_bands)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def event_descriptors(samples,
+                      onsets,
+                      sample_rate: int,
+                      frame_size: int = SPECTRAL_FRAME_SIZE) -> dict[str, np.ndarray]:
+    # Loudness and spectral descriptors of all events at once, from a single FFT over the first frame of every event
+    samples = np.asarray(samples, dtype=np.float32)
+    onsets = np.asarray(onsets, dtype=np.int64)
+    if len(onsets) == 0 or len(samples) == 0:
+        return {
+            "rms": np.zeros(len(onsets), dtype=np.float32),
+            "peak": np.zeros(len(onsets), dtype=np.float32),
+            "spectral_centroid": np.zeros(len(onsets), dtype=np.float32),
+            "spectral_flatness": np.zeros(len(onsets), dtype=np.float32),
+            "mfcc": np.zeros((len(onsets), NUM_MFCC), dtype=np.float32)
+        }
+    frames = event_frames(samples, np.clip(onsets, 0, len(samples) - 1), frame_size)
+    frames *= np.hanning(frame_size).astype(np.float32)
+    power = np.square(np.abs(np.fft.rfft(frames, axis=1)))
+    magnitudes = np.sqrt(power)
+    frequencies = np.fft.rfftfreq(frame_size, 1 / sample_rate)
+    total = magnitudes.sum(axis=1)
+    centroid = np.where(total > 0, (magnitudes * frequencies).sum(axis=1) / np.maximum(total, 1e-12), 0)
+    log_power = np.log(power + 1e-10)
+    flatness = np.where(total > 0, np.exp(log_power.mean(axis=1)) / np.maximum(power.mean(axis=1), 1e-10), 0)
+    mel_energies = power.astype(np.float32) @ mel_filterbank(sample_rate, frame_size).T
+    mfcc = np.log(mel_energies + 1e-10) @ dct_matrix().T
+    return {
+        "rms": event_rms(samples, onsets),
+        "peak": event_peak(samples, onsets),
+        "spectral_centroid": centroid.astype(np.float32),
+        "spectral_flatness": flatness.astype(np.float32),
+        "mfcc": mfcc.astype(np.float32)
+    }
+
+
+def timbre_vectors(descriptors: dict[str, np.ndarray]) -> np.ndarray:
+    return np.column_stack([descriptors[name] for name in TIMBRE_DESCRIPTORS]
+                           + [np.asarray(descriptors["mfcc"]).reshape(-1, NUM_MFCC)]).astype(np.float64)
@@ -0,0 +1,814 @@
+import base64
+import dataclasses
+import functools
+import json
+import math
+import pathlib
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Optional, Union
+
+import numpy as np
+
+import analysis
+import audio_utils
+import features
+import helpers
+import strategies
+from AudioClip import AudioClip
+from AudioEvent import AudioEvent
+from AudioFilePool import AudioFilePool, shared_pool
+from AudioSource import AudioSource
+from FileChooser import FileChooser
+from GenerationSettings import GenerationSettings
+from Logger import Logger
+from analysis_cache import AnalysisCache
+from batch_manifest import BatchError, BatchManifest
+from constants import (LIBRARY_VARIATION_FRACTION, MAX_NUMBER_OF_SLICES, ONE_SHOT_MAX_SECONDS,
+                       ONE_SHOT_SLICE_THRESHOLD_SECONDS, ONSET_ENGINES, ONSET_METHODS, REQUEST_CHOICES,
+                       REQUEST_OPTIONS, REQUEST_RANGES, REQUEST_SETTINGS, SHORTEST_ONE_SHOT_SECONDS,
+                       SHUFFLE_STRATEGIES, SPLIT_THRESHOLD_IN_SECONDS, default_cache_dir)
+from library_index import LibraryIndex
+from library_manifest import scan_library
+from onsets import numpy_onset_method
+from pcm_cache import PcmCache
+from render import write_audio_clip
+
+
+class RequestError(ValueError):
+    """Raised for generation settings that the generate command would reject"""
+
+
+# Prebuilt index of the candidates a shuffle strategy matches source events against
+CandidateIndex = Union[helpers.ClosestValueIndex, helpers.PitchIndex, helpers.NearestNeighbourIndex]
+
+
+def generate(source_dir: Union[str, pathlib.Path],
+             output: Union[str, pathlib.Path],
+             substitution_dir: Optional[Union[str, pathlib.Path]] = None,
+             number_of_seqs: int = 1,
+             seed: Optional[int] = None,
+             recurse_sub_dirs: bool = False,
+             use_manifest: bool = True,
+             index_file: Optional[pathlib.Path] = None,
+             onset_method: str = "specflux",
+             onset_engine: str = "aubio",
+             cache_dir: Optional[pathlib.Path] = None,
+             no_cache: bool = False,
+             cache_size: int = 256,
+             pcm_cache_size: int = 0,
+             jobs: int = 1,
+             prefetch: int = 1,
+             batch_file: Optional[pathlib.Path] = None,
+             shard: Optional[tuple[int, int]] = None,
+             logger: Optional[Logger] = None,
+             **request) -> list[pathlib.Path]:
+    """Generates loops like the generate command, for use as a library. Takes any of the settings of a generation
+    request, like strategy, generation_depth or event_counts, as keyword arguments. Returns the paths of the written
+    files, and raises ValueError for invalid settings"""
+    logger = logger or Logger(quiet=True)
+    if onset_method not in ONSET_METHODS or onset_engine not in ONSET_ENGINES:
+        raise ValueError(f"Unknown onset method {onset_method} or engine {onset_engine}")
+    if onset_engine == "numpy":
+        numpy_onset_method(onset_method)
+    source_infos, substitution_infos = scan_library(source_dir, substitution_dir, recurse_sub_dirs, use_manifest,
+                                                    logger)
+    if not source_infos:
+        raise ValueError(f"No audio files were found in {source_dir}")
+    cache_dir = cache_dir or default_cache_dir()
+    base_settings = GenerationSettings(
+        source_files=[info.path for info in source_infos],
+        substitution_files=[info.path for info in substitution_infos],
+        file_durations={str(info.path): info.duration for info in source_infos + substitution_infos},
+        output=pathlib.Path(output),
+        onset_method=onset_method,
+        onset_engine=onset_engine,
+        cache_dir=None if no_cache else cache_dir,
+        cache_size=cache_size,
+        pcm_cache_dir=cache_dir / "pcm" if pcm_cache_size > 0 else None,
+        pcm_cache_size=pcm_cache_size,
+        index_file=index_file,
+        log_level=logger.logLevel,
+        profile=logger.profile,
+        quiet=logger.quiet
+    )
+    settings = apply_request(base_settings, request)
+    request_value("number_of_seqs", number_of_seqs, int)
+    output_filenames = run_generation(settings, number_of_seqs, seed, logger, jobs, prefetch, batch_file, shard)
+    return [pathlib.Path(f"{output_filename}.wav") for output_filename in output_filenames]
+
+
+def run_generation(settings: GenerationSettings,
+                   number_of_seqs: int,
+                   seed: Optional[int],
+                   logger: Logger,
+                   jobs: int = 1,
+                   prefetch: int = 1,
+                   batch_file: Optional[pathlib.Path] = None,
+                   shard: Optional[tuple[int, int]] = None) -> list[pathlib.Path]:
+    # Every sequence gets its own child seed, so the output does not depend on how sequences are spread over workers
+    seed_sequences = np.random.SeedSequence(None if seed in (None, -1) else seed).spawn(number_of_seqs)
+    configure_pool(settings)
+    if batch_file is not None:
+        manifest = BatchManifest(batch_file)
+        try:
+            seed_sequences = create_batch(manifest, seed_sequences, seed not in (None, -1), settings)
+            logger.activate()
+            return run_batch(manifest, shard, settings, logger, jobs)
+        finally:
+            manifest.close()
+    if jobs == 1 and prefetch > 0 and number_of_seqs > 1:
+        logger.activate()
+        return generate_outputs_pipelined(seed_sequences, settings, logger, prefetch)
+    if jobs == 1:
+        logger.activate()
+        return generate_outputs(seed_sequences, settings, logger)
+    # Settings are sent to every worker once, rather than with every sequence
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(settings,)) as executor:
+        futures = [executor.submit(generate_worker_output, i, seed_sequence)
+                   for i, seed_sequence in enumerate(seed_sequences)]
+        output_filenames = []
+        try:
+            for future in futures:
+                sequence_output_filenames, spans = future.result()
+                output_filenames += sequence_output_filenames
+                logger.spans.extend(spans)
+        except BaseException:
+            # Once a sequence fails, the sequences that have not started are not generated
+            executor.shutdown(cancel_futures=True)
+            raise
+    return output_filenames
+
+
+_worker_settings: Optional[GenerationSettings] = None
+
+
+def init_worker(settings: GenerationSettings):
+    global _worker_settings
+    _worker_settings = settings
+    configure_pool(settings)
+
+
+def configure_pool(settings: GenerationSettings):
+    shared_pool.pcm_cache = None if settings.pcm_cache_dir is None else PcmCache(settings.pcm_cache_dir,
+                                                                                 settings.pcm_cache_size * 1024 * 1024)
+
+
+def generate_worker_output(sequence_index: int,
+                           seed_sequence: np.random.SeedSequence) -> tuple[list[pathlib.Path], list]:
+    # Spans are handed back to the parent process, which reports on all sequences together
+    logger = Logger(logLevel=_worker_settings.log_level, profile=_worker_settings.profile,
+                    quiet=_worker_settings.quiet)
+    logger.activate()
+    return generate_output(sequence_index, seed_sequence, _worker_settings, logger), logger.spans
+
+
+def generate_output(sequence_index: int,
+                    seed_sequence: np.random.SeedSequence,
+                    settings: GenerationSettings,
+                    logger: Optional[Logger] = None) -> list[pathlib.Path]:
+    logger = logger or Logger(logLevel=settings.log_level, quiet=settings.quiet)
+    output_filenames = []
+    with logger.sequence_span(sequence_index):
+        for variation, rng, source_clip, substitution_clips in load_variations(sequence_index, seed_sequence,
+                                                                               settings, logger):
+            result = match_sequence(rng, source_clip, substitution_clips, settings, logger)
+            output_filenames.append(write_sequence(sequence_index, result, settings, logger, variation))
+    return output_filenames
+
+
+def generate_outputs(seed_sequences: List[np.random.SeedSequence],
+                     settings: GenerationSettings,
+                     logger: Logger) -> list[pathlib.Path]:
+    return [output_filename for i, seed_sequence in enumerate(seed_sequences)
+            for output_filename in generate_output(i, seed_sequence, settings, logger)]
+
+
+def batch_parameters(settings: GenerationSettings) -> dict:
+    # Everything that changes the output for a given seed. JSON round trips turn tuples into lists, so parameters read
+    # back from a manifest compare equal
+    parameters = {name: getattr(settings, name) for name in REQUEST_SETTINGS}
+    parameters.update(options=settings.options, onset_method=settings.onset_method,
+                      onset_engine=settings.onset_engine,
+                      index_file=None if settings.index_file is None else str(settings.index_file))
+    return json.loads(json.dumps(parameters))
+
+
+def choose_source_file(sequence_index: int,
+                       seed_sequence: np.random.SeedSequence,
+                       settings: GenerationSettings) -> str:
+    # The source file is the first pick from the random stream of a sequence, so it is known without loading anything
+    return str(make_file_chooser(np.random.default_rng(seed_sequence), sequence_index, settings)
+               .choose(settings.source_files))
+
+
+def create_batch(manifest: BatchManifest,
+                 seed_sequences: List[np.random.SeedSequence],
+                 seed_given: bool,
+                 settings: GenerationSettings) -> List[np.random.SeedSequence]:
+    """Writes the jobs of a new batch to the manifest, or checks that an existing batch was created with the same
+    settings. Returns the seeds of the batch, which for a batch created without a seed are the ones drawn back then"""
+    parameters = batch_parameters(settings)
+    entropy = str(seed_sequences[0].entropy)
+    batch = manifest.create({"entropy": entropy, "number_of_seqs": len(seed_sequences), "parameters": parameters},
+                            [(i, seed_sequence, choose_source_file(i, seed_sequence, settings), parameters)
+                             for i, seed_sequence in enumerate(seed_sequences)])
+    if batch["number_of_seqs"] != len(seed_sequences):
+        raise BatchError(f"{manifest.path} holds a batch of {batch['number_of_seqs']} sequences, not "
+                         f"{len(seed_sequences)}")
+    changed = sorted(name for name in set(parameters) | set(batch["parameters"])
+                     if parameters.get(name) != batch["parameters"].get(name))
+    if changed:
+        raise BatchError(f"{manifest.path} was created with different settings for {', '.join(changed)}")
+    if batch["entropy"] == entropy:
+        return seed_sequences
+    # A batch started without a seed keeps the one it drew, so that every run and shard uses the same seeds
+    if seed_given:
+        raise BatchError(f"{manifest.path} was created with seed {batch['entropy']}")
+    return np.random.SeedSequence(int(batch["entropy"])).spawn(len(seed_sequences))
+
+
+def run_batch(manifest: BatchManifest,
+              shard: Optional[tuple[int, int]],
+              settings: GenerationSettings,
+              logger: Logger,
+              jobs: int) -> list[pathlib.Path]:
+    # Sequences are claimed one at a time, so workers that share the manifest never generate the same sequence, and a
+    # sequence that fails is handed back for the next run
+    claimed = set()
+    completed = {}
+
+    def claim_next() -> Optional[tuple[int, np.random.SeedSequence]]:
+        job = manifest.claim(shard)
+        if job is None:
+            return None
+        sequence_index, seed_sequence, source_file = job
+        claimed.add(sequence_index)
+        if choose_source_file(sequence_index, seed_sequence, settings) != source_file:
+            raise BatchError(f"Sequence {sequence_index} of {manifest.path} was planned with source file "
+                             f"{source_file}, which is not the one chosen from the current source files")
+        return sequence_index, seed_sequence
+
+    def complete(sequence_index: int, output_filenames: list[pathlib.Path]):
+        manifest.complete(sequence_index, output_filenames)
+        claimed.discard(sequence_index)
+        completed[sequence_index] = output_filenames
+
+    try:
+        if jobs == 1:
+            while (job := claim_next()) is not None:
+                complete(job[0], generate_output(*job, settings, logger))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(settings,)) as executor:
+                running = {}
+                try:
+                    while True:
+                        while len(running) < jobs and (job := claim_next()) is not None:
+                            running[executor.submit(generate_worker_output, *job)] = job[0]
+                        if not running:
+                            break
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            output_filenames, spans = future.result()
+                            complete(running.pop(future), output_filenames)
+                            logger.spans.extend(spans)
+                except BaseException:
+                    # Claimed sequences that have not started are released for the next run without being generated
+                    executor.shutdown(cancel_futures=True)
+                    raise
+    finally:
+        for sequence_index in claimed:
+            manifest.release(sequence_index)
+    progress = manifest.progress()
+    logger.echo(f"Batch {manifest.path}: {progress.get('done', 0)} of {sum(progress.values())} sequences done")
+    return [output_filename for i in sorted(completed) for output_filename in completed[i]]
+
+
+def generate_outputs_pipelined(seed_sequences: List[np.random.SeedSequence],
+                               settings: GenerationSettings,
+                               logger: Logger,
+                               prefetch: int) -> list[pathlib.Path]:
+    # Sources and substitutions for upcoming sequences are loaded on one thread and finished sequences are written on
+    # another, while the current sequence is matched. Every sequence has its own RNG, so results match a serial run.
+    loaded = queue.Queue(maxsize=prefetch)
+    finished = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+    write_errors = []
+    output_filenames = []
+
+    def put_unless_stopped(item) -> bool:
+        while not stopped.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load_all():
+        # Once the run stops, because of an error or an interrupt, nothing more is loaded
+        try:
+            for i, seed_sequence in enumerate(seed_sequences):
+                if stopped.is_set():
+                    return
+                with logger.sequence_context(i):
+                    for variation, *loaded_variation in load_variations(i, seed_sequence, settings, logger):
+                        if not put_unless_stopped(((i, variation), loaded_variation)):
+                            return
+            put_unless_stopped(None)
+        except BaseException as e:
+            put_unless_stopped(e)
+
+    def write_all():
+        while True:
+            item = finished.get()
+            if item is None:
+                return
+            if write_errors:
+                continue
+            (i, variation), result = item
+            try:
+                with logger.sequence_context(i):
+                    output_filenames.append(write_sequence(i, result, settings, logger, variation))
+            except BaseException as e:
+                write_errors.append(e)
+
+    loader = threading.Thread(target=load_all, name="beatpainter-loader", daemon=True)
+    writer = threading.Thread(target=write_all, name="beatpainter-writer", daemon=True)
+    loader.start()
+    writer.start()
+    try:
+        while not write_errors:
+            item = loaded.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            (i, variation), (rng, source_clip, substitution_clips) = item
+            with logger.sequence_context(i):
+                finished.put(((i, variation), match_sequence(rng, source_clip, substitution_clips, settings, logger)))
+    finally:
+        stopped.set()
+        finished.put(None)
+        writer.join()
+        loader.join()
+    if write_errors:
+        raise write_errors[0]
+    return output_filenames
+
+
+def load_variations(sequence_index: int,
+                    seed_sequence: np.random.SeedSequence,
+                    settings: GenerationSettings,
+                    logger: Logger) -> Iterator[tuple[int, np.random.Generator, AudioClip, list[AudioClip]]]:
+    # The source clip is chosen and analysed once, after which every variation draws its own substitutions. With a
+    # single variation, it uses the random stream of the sequence itself, so outputs match those of earlier versions.
+    rng = np.random.default_rng(seed_sequence)
+    file_chooser = make_file_chooser(rng, sequence_index, settings)
+    source_clip = load_source(file_chooser, settings, logger)
+    if settings.variations_per_source == 1:
+        yield 0, rng, source_clip, load_substitutions(source_clip, file_chooser, settings, logger)
+        return
+    for variation, variation_seed in enumerate(seed_sequence.spawn(settings.variations_per_source)):
+        variation_rng = np.random.default_rng(variation_seed)
+        variation_index = sequence_index * settings.variations_per_source + variation
+        variation_chooser = make_file_chooser(variation_rng, variation_index, settings)
+        yield variation, variation_rng, source_clip, load_substitutions(source_clip, variation_chooser, settings,
+                                                                         logger)
+
+
+def make_file_chooser(rng: np.random.Generator, index: int, settings: GenerationSettings) -> FileChooser:
+    return FileChooser(rng, settings.file_selection_method, index, settings.file_weighting, settings.file_durations,
+                       settings.avoid_repeats)
+
+
+def load_source(file_chooser: FileChooser, settings: GenerationSettings, logger: Logger) -> AudioClip:
+    rng = file_chooser.rng
+    analysis_cache = None if settings.cache_dir is None else get_analysis_cache(settings.cache_dir,
+                                                                                 settings.cache_size)
+    with logger.span("source"):
+        selected_file = str(file_chooser.choose(settings.source_files))
+        logger.echo(f"Selected file {selected_file}")
+        source_clip = get_audio_clip(selected_file, rng.random(),
+                                     rng.integers(settings.min_duration, high=settings.max_duration), settings.trim,
+                                     settings.onset_method, analysis_cache, settings.sample_rate,
+                                     settings.onset_engine)
+        logger.echo(f"Got clip with {len(source_clip.events)} events")
+    return source_clip
+
+
+def load_substitutions(source_clip: AudioClip,
+                       file_chooser: FileChooser,
+                       settings: GenerationSettings,
+                       logger: Logger) -> list[AudioClip]:
+    rng = file_chooser.rng
+    analysis_cache = None if settings.cache_dir is None else get_analysis_cache(settings.cache_dir,
+                                                                                 settings.cache_size)
+    with_pitch = settings.strategy == "ShuffleByPitch"
+    with logger.span("substitution"):
+        if settings.index_file is not None:
+            library_index, library_clip = load_library_index(settings.index_file, source_clip.sample_rate)
+            if settings.strategy in SHUFFLE_STRATEGIES:
+                substitution_clips = [library_clip if settings.variations_per_source == 1
+                                      else sample_library_clip(rng, library_clip)]
+            else:
+                substitution_clips = [library_index.get_clip(rng, settings.min_duration, settings.max_duration,
+                                                              source_clip.sample_rate)
+                                      for _ in range(settings.generation_depth)]
+        else:
+            substitution_clips = get_substitution_clips(settings.substitution_files, settings.generation_depth,
+                                                        settings.min_duration, settings.max_duration,
+                                                        settings.one_shot_mode, source_clip, file_chooser,
+                                                        settings.trim, analysis_cache,
+                                                        file_durations=settings.file_durations,
+                                                        with_pitch=with_pitch,
+                                                        with_descriptors=settings.strategy == "ShuffleByTimbre",
+                                                        onset_engine=settings.onset_engine)
+    return substitution_clips
+
+
+def sample_library_clip(rng: np.random.Generator, library_clip: AudioClip) -> AudioClip:
+    # Shuffle strategies pick the closest events deterministically, so variations matched against the whole library
+    # would all be the same. Every variation draws its candidates from a random part of it instead
+    if not library_clip.events:
+        return library_clip
+    num_events = max(1, int(len(library_clip.events) * LIBRARY_VARIATION_FRACTION))
+    event_ids = np.sort(rng.choice(len(library_clip.events), num_events, replace=False))
+    return library_clip.select(event_ids)
+
+
+def match_sequence(rng: np.random.Generator,
+                   source_clip: AudioClip,
+                   substitution_clips: list[AudioClip],
+                   settings: GenerationSettings,
+                   logger: Logger) -> AudioClip:
+    with logger.span("strategy"):
+        # Variations match against a part of the library, which is indexed by the strategy itself
+        candidate_index = load_candidate_index(settings, source_clip.sample_rate) \
+            if settings.index_file is not None and settings.variations_per_source == 1 else None
+        result_events = generate_sequence(settings.strategy, source_clip, substitution_clips, settings.options,
+                                          candidate_index, rng)
+    return AudioClip(result_events, source_clip.sample_rate, source_clip.num_channels)
+
+
+def write_sequence(sequence_index: int,
+                   result: AudioClip,
+                   settings: GenerationSettings,
+                   logger: Logger,
+                   variation: int = 0) -> pathlib.Path:
+    # Variations of the same source clip are numbered after the sequence, so they are listed together
+    output_name = f"{settings.output_prefix}-{sequence_index}"
+    if settings.variations_per_source > 1:
+        output_name += f"-{variation}"
+    output_filename = pathlib.Path(settings.output, output_name)
+    write_audio_clip(str(output_filename), result, settings.bit_depth,
+                     tail=int(settings.tail_ms * result.sample_rate / 1000),
+                     chunk_size=settings.render_chunk_seconds * result.sample_rate or None,
+                     fade_shape=settings.fade_shape)
+    logger.log(f"Audio file pool after sequence {sequence_index}: {shared_pool.stats()}")
+    return output_filename
+
+
+# Loaded once per process, so that worker processes only pay for it on their first sequence
+@functools.lru_cache(maxsize=1)
+def read_library_index(index_file: pathlib.Path) -> LibraryIndex:
+    return LibraryIndex.load(index_file)
+
+
+# Source clips of different rates need a library clip at their rate
+@functools.lru_cache(maxsize=4)
+def load_library_index(index_file: pathlib.Path, sample_rate: Optional[int] = None) -> tuple[LibraryIndex, AudioClip]:
+    library_index = read_library_index(index_file)
+    return library_index, library_index.get_library_clip(sample_rate)
+
+
+def load_candidate_index(settings: GenerationSettings, sample_rate: int) -> Optional[CandidateIndex]:
+    # The events of a library index only have to be indexed once per run for the strategy to match against them
+    if settings.strategy == "ShuffleByDuration" and not settings.options["normalize_durations"]:
+        return load_duration_index(settings.index_file, sample_rate)
+    if settings.strategy == "ShuffleByPitch":
+        return load_pitch_index(settings.index_file, sample_rate, settings.options.get("duration_tie_break", True))
+    if settings.strategy == "ShuffleByTimbre":
+        return load_timbre_index(settings.index_file)
+    return None
+
+
+@functools.lru_cache(maxsize=4)
+def load_duration_index(index_file: pathlib.Path, sample_rate: int) -> helpers.ClosestValueIndex:
+    _, library_clip = load_library_index(index_file, sample_rate)
+    return helpers.ClosestValueIndex(library_clip.event_feature("duration"))
+
+
+@functools.lru_cache(maxsize=4)
+def load_pitch_index(index_file: pathlib.Path, sample_rate: int, duration_tie_break: bool) -> helpers.PitchIndex:
+    _, library_clip = load_library_index(index_file, sample_rate)
+    return helpers.PitchIndex(library_clip.event_feature("pitch"), library_clip.event_feature("duration"),
+                              semitone_groups=duration_tie_break)
+
+
+@functools.lru_cache(maxsize=1)
+def load_timbre_index(index_file: pathlib.Path) -> helpers.NearestNeighbourIndex:
+    library_index = read_library_index(index_file)
+    return strategies.build_timbre_index(library_index.timbre_vectors())
+
+
+# Shared by every sequence of the process, so that analyses it already loaded stay in memory
+@functools.lru_cache(maxsize=1)
+def get_analysis_cache(cache_dir: pathlib.Path, cache_size: int) -> AnalysisCache:
+    return AnalysisCache(cache_dir, cache_size * 1024 * 1024)
+
+
+def request_value(name: str, value, value_type: type):
+    # Raises RequestError for anything the generate command would reject, which the server reports as a bad request
+    if value_type is list:
+        if not isinstance(value, list) or not value:
+            raise RequestError(f"{name} must be a non-empty list")
+        return [request_value(name, item, int) for item in value]
+    if value_type is bool:
+        if not isinstance(value, bool):
+            raise RequestError(f"{name} must be true or false")
+        return value
+    if value_type is int and (isinstance(value, bool) or not isinstance(value, int)):
+        raise RequestError(f"{name} must be an integer")
+    if value_type is str and not isinstance(value, str):
+        raise RequestError(f"{name} must be a string")
+    if name in REQUEST_CHOICES:
+        choices = {str(choice).lower(): choice for choice in REQUEST_CHOICES[name]}
+        if str(value).lower() not in choices:
+            raise RequestError(f"{name} must be one of {', '.join(map(str, REQUEST_CHOICES[name]))}")
+        value = choices[str(value).lower()]
+    if name in REQUEST_RANGES:
+        low, high = REQUEST_RANGES[name]
+        if not low <= value <= high:
+            raise RequestError(f"{name} must be between {low} and {high}")
+    return value
+
+
+def apply_request(base_settings: GenerationSettings, request: dict) -> GenerationSettings:
+    unknown = set(request) - set(REQUEST_SETTINGS) - set(REQUEST_OPTIONS)
+    if unknown:
+        raise RequestError(f"Unknown request fields: {', '.join(sorted(unknown))}")
+    changes = {name: request_value(name, request[name], value_type)
+               for name, value_type in REQUEST_SETTINGS.items() if name in request}
+    options = dict(base_settings.options, **{name: request_value(name, request[name], value_type)
+                                             for name, value_type in REQUEST_OPTIONS.items() if name in request})
+    settings = dataclasses.replace(base_settings, options=options, **changes)
+    if pathlib.Path(settings.output_prefix).name != settings.output_prefix:
+        raise RequestError("output_prefix must be a file name")
+    if settings.min_duration >= settings.max_duration:
+        raise RequestError("min_duration must be less than max_duration")
+    if settings.one_shot_mode != "false":
+        settings.index_file = None
+    if not settings.substitution_files and settings.index_file is None:
+        raise RequestError("No substitution files or library index to draw substitutions from")
+    return settings
+
+
+def generate_request(base_settings: GenerationSettings, request: dict, logger: Logger) -> dict:
+    settings = apply_request(base_settings, {name: value for name, value in request.items()
+                                             if name not in ["seed", "number_of_seqs", "return_audio"]})
+    number_of_seqs = request_value("number_of_seqs", request.get("number_of_seqs", 1), int)
+    # Without a seed, a fresh one is drawn and returned, so that the request can be repeated
+    seed = request.get("seed")
+    seed = np.random.SeedSequence().entropy if seed is None else request_value("seed", seed, int)
+    output_filenames = generate_outputs(np.random.SeedSequence(seed).spawn(number_of_seqs), settings, logger)
+    response = {"seed": seed, "outputs": [f"{output_filename}.wav" for output_filename in output_filenames]}
+    if request_value("return_audio", request.get("return_audio", False), bool):
+        response["audio"] = [base64.b64encode(pathlib.Path(output).read_bytes()).decode("ascii")
+                             for output in response["outputs"]]
+    return response
+
+
+def generate_sequence(strategy: str,
+                      source_clip: AudioClip,
+                      substitution_clips: list[AudioClip],
+                      options: dict,
+                      candidate_index: Optional[CandidateIndex] = None,
+                      rng: Optional[np.random.Generator] = None) -> list[AudioEvent]:
+    if strategy == "ShuffleByDuration":
+        return strategies.shuffle_by_duration(source_clip, substitution_clips,
+                                              normalize_durations=options["normalize_durations"],
+                                              candidate_index=candidate_index)
+    if strategy == "ShuffleByPitch":
+        return strategies.shuffle_by_pitch(source_clip, substitution_clips,
+                                           duration_tie_break=options.get("duration_tie_break", True),
+                                           candidate_index=candidate_index)
+    if strategy == "ShuffleByTimbre":
+        return strategies.shuffle_by_timbre(source_clip, substitution_clips, candidate_index)
+    if strategy == "Interleave":
+        return strategies.interleave(source_clip, substitution_clips, event_counts=options["event_counts"])
+
+    if strategy == "InterleavedShuffle":
+        return strategies.interleaved_shuffle(source_clip, substitution_clips, event_counts=options["event_counts"],
+                                              rng=rng if rng is not None else np.random.default_rng())
+
+    if strategy == "InterleaveInPlace":
+        return strategies.interleave_in_place(source_clip, substitution_clips, event_counts=options["event_counts"])
+
+    return []
+
+
+def get_substitution_clips(substitution_files,
+                           generation_depth: int,
+                           min_duration: int,
+                           max_duration: int,
+                           one_shot_mode: str,
+                           source_clip: AudioClip,
+                           file_chooser: FileChooser,
+                           trim: bool,
+                           analysis_cache: Optional[AnalysisCache] = None,
+                           pool: AudioFilePool = shared_pool,
+                           file_durations: Optional[dict[str, float]] = None,
+                           with_pitch: bool = False,
+                           with_descriptors: bool = False,
+                           onset_engine: str = "aubio") -> list[AudioClip]:
+    # One shots are read at the sample rate of the source clip, so that they line up with its events
+    sample_rate = source_clip.sample_rate
+    one_shot_length = int(ONE_SHOT_MAX_SECONDS * sample_rate)
+    shortest_one_shot = int(SHORTEST_ONE_SHOT_SECONDS * sample_rate)
+    clips = list()
+    if one_shot_mode == "true":
+        for _ in range(generation_depth):
+            # num_events = rng.integers(source_events_length, source_events_length + round(source_events_length / 2))
+            events: List[AudioEvent] = []
+            filenames = file_chooser.choose_many(substitution_files, len(source_clip.events))
+            for event, filename in zip(source_clip.events, filenames):
+                events.append(get_audio_event(str(filename), 0, one_shot_length, event.start,
+                                              event.duration, False, pool, with_descriptors, sample_rate,
+                                              with_pitch))
+            clips.append(AudioClip(events, sample_rate, source_clip.num_channels))
+    elif one_shot_mode == "long":
+        for _ in range(generation_depth):
+            events: List[AudioEvent] = []
+            cur_event_ix = 0
+            while cur_event_ix < len(source_clip.events):
+                filename: str = str(file_chooser.choose(substitution_files))
+                if file_durations and filename in file_durations:
+                    file_length_samples = int(file_durations[filename] * sample_rate)
+                else:
+                    file_length_samples = pool.frames(filename, sample_rate)
+                # Long one shot mode is only enabled for files longer than a certain threshold
+                if file_length_samples > ONE_SHOT_SLICE_THRESHOLD_SECONDS * sample_rate:
+                    num_slices = len(source_clip.events)
+                    slice_length = int(math.floor(file_length_samples / num_slices))
+                    if slice_length < shortest_one_shot:
+                        slice_length = shortest_one_shot
+                        num_slices = int(math.floor(file_length_samples / shortest_one_shot))
+                    num_slices = min(len(source_clip.events) - cur_event_ix, num_slices)
+                    events.extend(get_slices(filename, cur_event_ix, num_slices, slice_length, source_clip, pool,
+                                             with_descriptors, with_pitch))
+                    cur_event_ix += len(events)
+                    
+                else:
+                    if cur_event_ix >= len(source_clip.events):
+                        break
+                    ev = get_audio_event(filename,
+                                         0,
+                                         one_shot_length,
+                                         source_clip.events[cur_event_ix].start,
+                                         source_clip.events[cur_event_ix].duration,
+                                         False,
+                                         pool,
+                                         with_descriptors,
+                                         sample_rate,
+                                         with_pitch)
+                    events.append(ev)
+                    cur_event_ix += 1
+            clips.append(AudioClip(events, sample_rate, source_clip.num_channels))
+    else:    
+        for _ in range(generation_depth):
+            file: str = str(file_chooser.choose(substitution_files))
+            duration = file_chooser.rng.integers(min_duration, high=max_duration)
+            clips.append(get_audio_clip(file, file_chooser.rng.random(), duration, trim,
+                                        analysis_cache=analysis_cache, sample_rate=sample_rate,
+                                        onset_engine=onset_engine))
+
+    return clips
+
+
+def get_slices(filename: str,
+               cur_event_ix: int,
+               num_slices: int,
+               slice_length: int,
+               source_clip: AudioClip,
+               pool: AudioFilePool = shared_pool,
+               with_descriptors: bool = False,
+               with_pitch: bool = False) -> List[AudioEvent]:
+    slices: List[AudioEvent] = []
+    one_shot_length = int(ONE_SHOT_MAX_SECONDS * source_clip.sample_rate)
+    for i in range(min(num_slices, MAX_NUMBER_OF_SLICES)):
+        if cur_event_ix >= len(source_clip.events):
+            break
+        start_time = i * slice_length
+        slices.append(get_audio_event(filename,
+                                      start_time,
+                                      start_time + min(one_shot_length, slice_length),
+                                      source_clip.events[cur_event_ix].start,
+                                      source_clip.events[cur_event_ix].duration,
+                                      i > 0,
+                                      pool,
+                                      with_descriptors,
+                                      source_clip.sample_rate,
+                                      with_pitch))
+        cur_event_ix += 1
+    return slices
+
+
+def get_audio_event(filename: str,
+                    start_time_samples: int,
+                    end_time_samples: int,
+                    map_to_onset_samples: int,
+                    map_to_duration_samples: int,
+                    should_fade_in: bool,
+                    pool: AudioFilePool = shared_pool,
+                    with_descriptors: bool = False,
+                    sample_rate: Optional[int] = None,
+                    with_pitch: bool = False) -> AudioEvent:
+    # With a sample rate, times are in frames at that rate and the audio is resampled to it
+    frames = pool.frames(filename, sample_rate)
+    if start_time_samples >= frames:
+        start_time_samples = 0
+    if end_time_samples >= frames:
+        end_time_samples = frames - 1
+    duration = end_time_samples - start_time_samples
+    event = AudioEvent(map_to_onset_samples, map_to_duration_samples, 0, None, 0, should_fade_in,
+                       source=AudioSource(filename, start_time_samples, duration, sample_rate))
+    if not (with_descriptors or with_pitch):
+        # Descriptors and pitch need the audio, so one shots are otherwise only decoded once a strategy picks them
+        return event
+    samples = pool.read(filename, start_time_samples, duration, sample_rate)
+    event._audio_data = samples
+    if with_pitch:
+        event.pitch = analysis.estimate_pitch(samples, sample_rate or pool.samplerate(filename))
+    if with_descriptors:
+        descriptors = features.event_descriptors(audio_utils.downmix(samples), [0],
+                                                 sample_rate or pool.samplerate(filename))
+        event.rms = float(descriptors["rms"][0])
+        event.peak = float(descriptors["peak"][0])
+        event.spectral_centroid = float(descriptors["spectral_centroid"][0])
+        event.spectral_flatness = float(descriptors["spectral_flatness"][0])
+        event.mfcc = descriptors["mfcc"][0]
+    return event
+
+# Could be nice to give audio events generated from one shots timing information (onset, duration), since it could be 
+# useful for processes like remapping events from substitution clips into event slots from a source_clip
+
+def get_audio_clip(filename: str,
+                   start_offset_fraction: float,
+                   duration_secs: int,
+                   trim: bool,
+                   aubio_method: str = "hfc",
+                   analysis_cache: Optional[AnalysisCache] = None,
+                   sample_rate: Optional[int] = None,
+                   onset_engine: str = "aubio") -> AudioClip:
+    # Onsets are detected over the whole file at its native rate, whether or not the analysis is cached, so that the
+    # cache never changes which events a clip has. With a sample rate, the clip is converted to that rate
+    win_s = analysis.ONSET_WINDOW_SIZE
+    hop_s = analysis.ONSET_HOP_SIZE
+    with shared_pool.open_reader(filename) as file:
+        duration_secs = helpers.clamp(duration_secs, 0, file.duration)
+        if file.duration < SPLIT_THRESHOLD_IN_SECONDS:
+            duration_secs = file.duration
+            trim = False
+        samplerate = int(file.samplerate)
+        num_channels = file.num_channels
+        start_offset = helpers.clamp(
+            int(file.duration * start_offset_fraction),
+            0,
+            file.duration - duration_secs
+        )
+        start_offset_samples = int(start_offset * file.samplerate)
+        num_samples = int(duration_secs * file.samplerate)
+        samples_read = max(min(num_samples, file.frames - start_offset_samples), 0)
+    # Nothing is decoded until an event is actually used. Every event gets the descriptors of the analysed event of
+    # the whole file it starts in
+    file_analysis = analysis.get_file_analysis(filename, aubio_method, analysis_cache, win_s, hop_s, onset_engine)
+    file_onsets = file_analysis["onsets"]
+    in_range = (file_onsets > start_offset_samples) & (file_onsets < start_offset_samples + samples_read)
+    # contains sample indexes to all onsets in the current clip, including start and end points
+    onsets = [0] + (file_onsets[in_range] - start_offset_samples).tolist() + [samples_read]
+    file_event_ids = np.maximum(np.searchsorted(file_onsets, start_offset_samples + np.array(onsets[0:-1]),
+                                                side="right") - 1, 0)
+    pitches = file_analysis["pitch"][file_event_ids]
+    descriptors = {name: file_analysis[name][file_event_ids] for name in features.TIMBRE_DESCRIPTORS + ["mfcc"]}
+    target_rate = samplerate if sample_rate is None else int(sample_rate)
+    if target_rate != samplerate:
+        onsets = [audio_utils.resampled_length(onset, samplerate, target_rate) for onset in onsets]
+        start_offset_samples = audio_utils.resampled_length(start_offset_samples, samplerate, target_rate)
+    events: List[AudioEvent] = list()
+    for ix, onset in enumerate(onsets[0:-1]):
+        duration = onsets[ix + 1] - onset
+        if duration <= 0:
+            # Onsets that fall on the same frame once converted to the target rate, or a clip without any frames
+            continue
+        events.append(AudioEvent(onset, duration, float(pitches[ix]), None,
+                                 float(descriptors["rms"][ix]), True,
+                                 source=AudioSource(filename, start_offset_samples + onset, duration, sample_rate),
+                                 peak=float(descriptors["peak"][ix]),
+                                 spectral_centroid=float(descriptors["spectral_centroid"][ix]),
+                                 spectral_flatness=float(descriptors["spectral_flatness"][ix]),
+                                 mfcc=descriptors["mfcc"][ix]))
+    if trim:
+        events = events[1:-1]
+    return AudioClip(events=events, sample_rate=target_rate, num_channels=num_channels)
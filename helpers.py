@@ -1,17 +1,147 @@
+import functools
+from typing import Optional
+
 import numpy as np
 
+# Number of targets compared against all candidates at once when no KD-tree implementation is available
+BRUTE_FORCE_CHUNK_SIZE = 256
+
+
+@functools.lru_cache(maxsize=1)
+def get_kd_tree() -> Optional[type]:
+    # Imported on first use, as scipy is slow to import and only timbre matching needs it
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        return None
+    return cKDTree
+
 
 def get_closest_index(number_list: list[int], target: int) -> int:
-    if len(number_list) == 0:
-        return 0
-    smallest_diff = abs(number_list[0] - target)
-    closest_index = 0
-    for i, number in enumerate(number_list[1:], 1):
-        diff = abs(number - target)
-        if diff < smallest_diff:
-            smallest_diff = diff
-            closest_index = i
-    return closest_index
+    return int(get_closest_indexes(number_list, [target])[0])
+
+
+def get_closest_indexes(number_list, targets) -> np.ndarray:
+    # Batched equivalent of get_closest_index: for every target, returns the index of the closest number,
+    # preferring the lowest index on ties
+    return ClosestValueIndex(number_list).query(targets)
+
+
+class ClosestValueIndex:
+    """Candidates sorted once, so that the closest candidate to any number of targets is found with binary searches"""
+
+    def __init__(self, values: np.ndarray):
+        values = np.asarray(values)
+        self.order = np.argsort(values, kind="stable")
+        self.sorted_values = values[self.order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, targets: np.ndarray) -> np.ndarray:
+        targets = np.asarray(targets)
+        if len(self.order) == 0:
+            return np.zeros(len(targets), dtype=np.int64)
+        sorted_values, order = self.sorted_values, self.order
+        right = np.clip(np.searchsorted(sorted_values, targets, side="left"), 0, len(order) - 1)
+        # Step back to the start of the run of equal values on the left, so the lowest index wins among equal values
+        left = np.searchsorted(sorted_values, sorted_values[np.maximum(right - 1, 0)], side="left")
+        right_diffs = np.abs(sorted_values[right] - targets)
+        left_diffs = np.abs(sorted_values[left] - targets)
+        choose_left = (left_diffs < right_diffs) | ((left_diffs == right_diffs) & (order[left] < order[right]))
+        return np.where(choose_left, order[left], order[right])
+
+
+class NearestNeighbourIndex:
+    """Multi-dimensional nearest neighbour lookup over weighted feature vectors, built once and queried in batches"""
+
+    def __init__(self, points: np.ndarray, weights: Optional[np.ndarray] = None):
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        self.weights = np.ones(points.shape[1]) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.points = points * self.weights
+        kd_tree = get_kd_tree()
+        self.tree = kd_tree(self.points) if kd_tree is not None and len(self.points) > 0 else None
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, targets: np.ndarray) -> np.ndarray:
+        targets = np.atleast_2d(np.asarray(targets, dtype=np.float64)) * self.weights
+        if len(self.points) == 0:
+            return np.zeros(len(targets), dtype=np.int64)
+        if self.tree is not None:
+            return self.tree.query(targets)[1].astype(np.int64)
+        result = np.empty(len(targets), dtype=np.int64)
+        for start in range(0, len(targets), BRUTE_FORCE_CHUNK_SIZE):
+            chunk = targets[start:start + BRUTE_FORCE_CHUNK_SIZE]
+            distances = np.square(chunk[:, np.newaxis, :] - self.points[np.newaxis, :, :]).sum(axis=2)
+            result[start:start + len(chunk)] = np.argmin(distances, axis=1)
+        return result
+
+
+class PitchIndex:
+    """Candidates sorted by pitch and then duration, so that the closest pitch, and the closest duration among the
+    candidates with that pitch, is found with binary searches"""
+
+    def __init__(self, pitches: np.ndarray, durations: np.ndarray, semitone_groups: bool = True):
+        # With semitone groups, pitches are rounded to whole midi notes, so events that play the same note are told
+        # apart by their duration
+        pitches = np.asarray(pitches, dtype=np.float64)
+        self.pitches = np.round(pitches) if semitone_groups else pitches
+        durations = np.asarray(durations, dtype=np.int64)
+        self.order = np.lexsort((durations, self.pitches))
+        self.unique_pitches, self.group_starts, self.group_sizes = np.unique(self.pitches[self.order],
+                                                                             return_index=True, return_counts=True)
+        self.sorted_durations = durations[self.order]
+        self.max_duration = int(durations.max(initial=0))
+        group_ids = np.repeat(np.arange(len(self.unique_pitches)), self.group_sizes)
+        self.keys = group_ids * (self.max_duration + 1) + self.sorted_durations
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, pitches: np.ndarray, durations: np.ndarray) -> np.ndarray:
+        if len(self.order) == 0:
+            return np.zeros(len(pitches), dtype=np.int64)
+        pitches = np.asarray(pitches, dtype=np.float64)
+        durations = np.clip(np.asarray(durations, dtype=np.int64), 0, self.max_duration)
+        groups = get_closest_indexes(self.unique_pitches, pitches)
+        first = self.group_starts[groups]
+        last = first + self.group_sizes[groups] - 1
+        right = np.clip(np.searchsorted(self.keys, groups * (self.max_duration + 1) + durations), first, last)
+        left = np.clip(right - 1, first, last)
+        left_diffs = np.abs(self.sorted_durations[left] - durations)
+        choose_left = left_diffs <= np.abs(self.sorted_durations[right] - durations)
+        return self.order[np.where(choose_left, left, right)]
+
+
+class AliasTable:
+    """Walker's alias method: after building the table in linear time, every weighted draw takes one uniform index
+    and one uniform number, no matter how many weights there are"""
+
+    def __init__(self, weights: np.ndarray):
+        weights = np.asarray(weights, dtype=np.float64)
+        count = len(weights)
+        total = weights.sum()
+        scaled = weights * (count / total) if total > 0 else np.ones(count)
+        self.probabilities = np.ones(count)
+        self.aliases = np.arange(count)
+        small = list(np.flatnonzero(scaled < 1))
+        large = list(np.flatnonzero(scaled >= 1))
+        while small and large:
+            less, more = small.pop(), large[-1]
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(large.pop())
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def sample(self, rng: np.random.Generator, size: Optional[int] = None) -> np.ndarray:
+        columns = rng.integers(len(self.aliases), size=size)
+        return np.where(rng.random(size=size) < self.probabilities[columns], columns, self.aliases[columns])
 
 
 def normalize(source_values: list[int], target_min: int, target_max: int) -> list[int]:
@@ -1,9 +0,0 @@
-from typing import List
-from pedalboard_native.io import AudioFile
-from AudioClip import AudioClip
-from AudioEvent import AudioEvent
-from main import SPLIT_THRESHOLD_IN_SECONDS
-import helpers
-import aubio
-
-
@@ -0,0 +1,174 @@
+import pathlib
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+import numpy as np
+
+import analysis
+import features
+from AudioClip import AudioClip
+from AudioEvent import AudioEvent
+from AudioSource import AudioSource
+from analysis_cache import AnalysisCache
+
+INDEX_COLUMNS = ["file_ids", "onsets", "durations", "rms", "pitch", "spectral_centroid", "peak", "spectral_flatness",
+                 "mfcc"]
+FEATURE_COLUMNS = ["rms", "pitch", "spectral_centroid", "peak", "spectral_flatness", "mfcc"]
+# Columns that are not stored as float32
+COLUMN_DTYPES = {"file_ids": np.int32, "onsets": np.int64, "durations": np.int64}
+# Number of files analysed together while indexing. Onsets of a batch are detected in one pass with the numpy engine,
+# and its decoded audio is held in memory until then
+INDEX_BATCH_FILES = 32
+
+
+class LibraryIndexError(ValueError):
+    """Raised for library indexes that substitutions cannot be drawn from"""
+
+
+@dataclass
+class LibraryIndex:
+    files: np.ndarray
+    sample_rates: np.ndarray
+    file_ids: np.ndarray
+    onsets: np.ndarray
+    durations: np.ndarray
+    rms: np.ndarray
+    pitch: np.ndarray
+    spectral_centroid: np.ndarray
+    peak: np.ndarray
+    spectral_flatness: np.ndarray
+    mfcc: np.ndarray
+    onset_method: str = "specflux"
+    onset_engine: str = "aubio"
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def save(self, path: pathlib.Path):
+        np.savez(path,
+                 files=self.files,
+                 sample_rates=self.sample_rates,
+                 onset_method=np.array(self.onset_method),
+                 onset_engine=np.array(self.onset_engine),
+                 **{column: getattr(self, column) for column in INDEX_COLUMNS})
+
+    @staticmethod
+    def load(path: pathlib.Path) -> "LibraryIndex":
+        with np.load(path) as data:
+            if len(data["files"]) == 0:
+                raise LibraryIndexError(f"Library index {path} contains no files")
+            return LibraryIndex(files=data["files"],
+                                sample_rates=data["sample_rates"],
+                                onset_method=str(data["onset_method"]),
+                                onset_engine=str(data["onset_engine"]) if "onset_engine" in data else "aubio",
+                                **{column: data[column] if column in data else empty_column(column, len(data["onsets"]))
+                                   for column in INDEX_COLUMNS})
+
+    def get_events(self, event_ids: np.ndarray, sample_rate: Optional[int] = None) -> List[AudioEvent]:
+        # Events only reference their position in the library; audio is decoded when an event is actually used. With
+        # a sample rate, onsets and durations are converted from the rate of each file to it
+        event_ids = np.asarray(event_ids, dtype=np.int64)
+        onsets, durations = self.positions(event_ids, sample_rate)
+        return [AudioEvent(0,
+                           int(durations[i]),
+                           float(self.pitch[ix]),
+                           None,
+                           float(self.rms[ix]),
+                           True,
+                           source=AudioSource(str(self.files[self.file_ids[ix]]),
+                                              int(onsets[i]),
+                                              int(durations[i]),
+                                              sample_rate),
+                           peak=float(self.peak[ix]),
+                           spectral_centroid=float(self.spectral_centroid[ix]),
+                           spectral_flatness=float(self.spectral_flatness[ix]),
+                           mfcc=self.mfcc[ix])
+                for i, ix in enumerate(event_ids)]
+
+    def positions(self, event_ids: np.ndarray, sample_rate: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        # Onsets and durations of the events, converted from the rate of each file to the sample rate if there is one
+        onsets, durations = self.onsets[event_ids], self.durations[event_ids]
+        if sample_rate is not None:
+            scales = sample_rate / self.sample_rates[self.file_ids[event_ids]]
+            onsets = np.ceil(onsets * scales).astype(np.int64)
+            durations = np.ceil((self.onsets[event_ids] + durations) * scales).astype(np.int64) - onsets
+        return onsets, durations
+
+    def timbre_vectors(self) -> np.ndarray:
+        return features.timbre_vectors({name: getattr(self, name) for name in features.TIMBRE_DESCRIPTORS + ["mfcc"]})
+
+    def get_library_clip(self, sample_rate: Optional[int] = None) -> AudioClip:
+        # The features strategies match on are taken from the index columns rather than gathered from the events
+        event_ids = np.arange(len(self))
+        _, durations = self.positions(event_ids, sample_rate)
+        return AudioClip(self.get_events(event_ids, sample_rate),
+                         sample_rate or int(np.max(self.sample_rates, initial=44100)),
+                         feature_arrays={"start": np.zeros(len(self)),
+                                         "duration": durations.astype(np.float64),
+                                         "pitch": self.pitch.astype(np.float64)})
+
+    def get_clip(self,
+                 rng: np.random.Generator,
+                 min_duration: int,
+                 max_duration: int,
+                 sample_rate: Optional[int] = None) -> AudioClip:
+        # Picks a random run of consecutive events from a random file, similar to what get_audio_clip extracts
+        if len(self.files) == 0:
+            raise LibraryIndexError("Library index contains no files")
+        file_id = rng.integers(len(self.files))
+        file_event_ids = np.flatnonzero(self.file_ids == file_id)
+        file_sample_rate = int(self.sample_rates[file_id])
+        if len(file_event_ids) == 0:
+            return AudioClip([], sample_rate or file_sample_rate)
+        target_length = rng.integers(min_duration, high=max_duration) * file_sample_rate
+        first = rng.integers(len(file_event_ids))
+        cumulative_durations = np.cumsum(self.durations[file_event_ids[first:]])
+        last = first + int(np.searchsorted(cumulative_durations, target_length)) + 1
+        events = self.get_events(file_event_ids[first:last], sample_rate)
+        start = 0
+        for event in events:
+            event.start = start
+            start += event.duration
+        return AudioClip(events, sample_rate or file_sample_rate)
+
+
+def build_library_index(files: List[pathlib.Path],
+                        onset_method: str,
+                        analysis_cache: Optional[AnalysisCache] = None,
+                        on_file_analysed: Optional[Callable[[str], None]] = None,
+                        onset_engine: str = "aubio") -> LibraryIndex:
+    file_names = []
+    sample_rates = []
+    columns = {column: [] for column in INDEX_COLUMNS}
+    for batch_start in range(0, len(files), INDEX_BATCH_FILES):
+        # Paths are stored resolved, so that the index can be used from any working directory
+        batch = [str(pathlib.Path(file).resolve()) for file in files[batch_start:batch_start + INDEX_BATCH_FILES]]
+        analyses = analysis.get_file_analyses(batch, onset_method, analysis_cache, onset_engine=onset_engine)
+        for filename, file_analysis in zip(batch, analyses):
+            if file_analysis is None:
+                continue
+            onsets = file_analysis["onsets"]
+            file_id = len(file_names)
+            file_names.append(filename)
+            sample_rates.append(int(file_analysis["samplerate"]))
+            columns["file_ids"].append(np.full(len(onsets), file_id, dtype=np.int32))
+            columns["onsets"].append(onsets)
+            columns["durations"].append(np.diff(np.append(onsets, file_analysis["frames"])))
+            for feature in FEATURE_COLUMNS:
+                columns[feature].append(file_analysis[feature])
+            if on_file_analysed is not None:
+                on_file_analysed(filename)
+    return LibraryIndex(files=np.array(file_names, dtype=str),
+                        sample_rates=np.array(sample_rates, dtype=np.int32),
+                        onset_method=onset_method,
+                        onset_engine=onset_engine,
+                        **{column: np.concatenate(values).astype(COLUMN_DTYPES.get(column, np.float32))
+                           if values else empty_column(column, 0)
+                           for column, values in columns.items()})
+
+
+def empty_column(column: str, num_events: int) -> np.ndarray:
+    # Also fills in features that are missing from indexes built by earlier versions
+    if column == "mfcc":
+        return np.zeros((num_events, features.NUM_MFCC), dtype=np.float32)
+    return np.zeros(num_events, dtype=COLUMN_DTYPES.get(column, np.float32))
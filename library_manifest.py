@@ -0,0 +1,101 @@
+import json
+import os
+import pathlib
+from typing import Callable, List, Optional
+
+from AudioFileInfo import AudioFileInfo
+from Logger import Logger
+from constants import AUDIO_FILE_PATTERNS, MANIFEST_FILENAME
+
+MANIFEST_VERSION = 1
+MANIFEST_FIELDS = ["frames", "samplerate", "num_channels", "duration", "size", "mtime_ns"]
+
+
+def probe_audio_file(path: pathlib.Path, stat: os.stat_result) -> AudioFileInfo:
+    # Imported here, as files are only probed when the manifest does not know them
+    from pedalboard_native.io import AudioFile
+    with AudioFile(str(path)) as file:
+        return AudioFileInfo(path, file.frames, file.samplerate, file.num_channels, file.duration,
+                             stat.st_size, stat.st_mtime_ns)
+
+
+def load_manifest(root: pathlib.Path) -> dict[str, dict]:
+    try:
+        with open(root / MANIFEST_FILENAME, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(root: pathlib.Path, entries: dict[str, dict]):
+    temp_path = root / f"{MANIFEST_FILENAME}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": entries}, f, separators=(",", ":"))
+    os.replace(temp_path, root / MANIFEST_FILENAME)
+
+
+def scan_audio_files(root: pathlib.Path,
+                     files: List[pathlib.Path],
+                     use_manifest: bool = True,
+                     on_error: Callable[[str], None] = lambda message: None) -> List[AudioFileInfo]:
+    # Only files that are new or changed since the manifest was written are opened
+    entries = load_manifest(root) if use_manifest else {}
+    scanned_entries = {}
+    infos = []
+    changed = False
+    for path in files:
+        relative_path = path.relative_to(root).as_posix()
+        try:
+            stat = path.stat()
+            entry = entries.get(relative_path)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                info = AudioFileInfo(path, **entry)
+            else:
+                info = probe_audio_file(path, stat)
+                changed = True
+        except (OSError, RuntimeError, ValueError) as e:
+            on_error(f"Skipping {path}: {e}")
+            continue
+        scanned_entries[relative_path] = {name: getattr(info, name) for name in MANIFEST_FIELDS}
+        infos.append(info)
+    if use_manifest:
+        # Entries in subdirectories are kept when only the top level was scanned
+        scanned_dirs = {relative_path.rpartition("/")[0] for relative_path in scanned_entries}
+        kept_entries = {relative_path: entry for relative_path, entry in entries.items()
+                        if relative_path not in scanned_entries
+                        and relative_path.rpartition("/")[0] not in scanned_dirs
+                        and (root / relative_path).exists()}
+        if changed or len(kept_entries) + len(scanned_entries) != len(entries):
+            try:
+                save_manifest(root, {**kept_entries, **scanned_entries})
+            except OSError as e:
+                on_error(f"Could not write manifest to {root}: {e}")
+    return infos
+
+
+def scan_library(source_dir: str,
+                 substitution_dir: Optional[str],
+                 recurse_sub_dirs: bool,
+                 use_manifest: bool,
+                 logger: Logger) -> tuple[list[AudioFileInfo], list[AudioFileInfo]]:
+    source_path = pathlib.Path(source_dir)
+    source_infos = scan_audio_files(source_path, get_audio_files(source_path, recurse_sub_dirs), use_manifest,
+                                    lambda message: logger.log(message, logger.WARNING))
+    substitution_path = pathlib.Path(substitution_dir) if substitution_dir else source_path
+    substitution_infos = scan_audio_files(substitution_path, get_audio_files(substitution_path, recurse_sub_dirs),
+                                          use_manifest, lambda message: logger.log(message, logger.WARNING))
+    return source_infos, substitution_infos
+
+
+def get_audio_files(path, recurse) -> List[pathlib.Path]:
+    if recurse:
+        return [p for pattern in AUDIO_FILE_PATTERNS
+                for p in path.rglob(pattern)
+                if not p.name.startswith('._')]
+    else:
+        return [p for pattern in AUDIO_FILE_PATTERNS
+                for p in path.glob(pattern)
+                if not p.name.startswith('._')]
@@ -1,32 +1,102 @@
 import click
-import numpy as np
-import aubio
-import helpers
-import strategies
-import math
 import pathlib
-from typing import List
-from pedalboard_native.io import AudioFile
-from AudioEvent import AudioEvent
-from AudioClip import AudioClip
-from FileChooser import FileChooser
+from typing import List, Optional
+from GenerationSettings import GenerationSettings
 from Logger import Logger
+from constants import (DEFAULT_INDEX_FILENAME, FADE_SHAPES, FILE_SELECTION_METHODS, FILE_WEIGHTINGS, MANIFEST_FILENAME,
+                       ONE_SHOT_MODES, ONSET_ENGINES, ONSET_METHODS, OUTPUT_BIT_DEPTHS, SPLIT_THRESHOLD_IN_SECONDS,
+                       STRATEGIES, default_cache_dir)
+from library_manifest import get_audio_files, scan_library
 
-# Files longer than this will have a random clip extracted from it
-SPLIT_THRESHOLD_IN_SECONDS = 15
-ONE_SHOT_SLICE_THRESHOLD_SECONDS = 3
-ONE_SHOT_SLICE_THRESHOLD_SAMPLES = ONE_SHOT_SLICE_THRESHOLD_SECONDS * 44100
-SHORTEST_ONE_SHOT = 4410
-ONE_SHOT_MAX_SAMPLE_SIZE = 44100 # 1s
-MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one shot
+# Only the standard library, click and the modules above are imported up front, so that --help, argument errors and
+# empty directories are reported right away. The generation code, with numpy and aubio, is imported by the commands
 
 
-@click.command()
+class DefaultCommandGroup(click.Group):
+    """Group that falls back to a default command, so that `main.py [OPTIONS]` keeps working"""
+
+    def __init__(self, *args, default_command: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if self.default_command is not None and (not args or (args[0] not in self.commands
+                                                              and args[0] not in ctx.help_option_names)):
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+
+def cache_options(command):
+    command = click.option("--cache-size",
+                           type=click.IntRange(1, None),
+                           default=256,
+                           show_default=True,
+                           help="Maximum size of the onset analysis cache in megabytes. Least recently used entries "
+                                "are evicted first")(command)
+    command = click.option("--no-cache",
+                           is_flag=True,
+                           help="Disable the onset analysis cache")(command)
+    command = click.option("--cache-dir",
+                           type=click.Path(file_okay=False, dir_okay=True, writable=True, path_type=pathlib.Path),
+                           default=default_cache_dir(),
+                           show_default=True,
+                           help="Directory used to cache onset analysis results between runs")(command)
+    return command
+
+
+def onset_method_option(command):
+    command = click.option("--onset-engine",
+                           type=click.Choice(ONSET_ENGINES, case_sensitive=False),
+                           default="aubio",
+                           show_default=True,
+                           help="Onset detection implementation. numpy analyses a whole clip in one vectorized pass "
+                                "and supports the specflux, hfc, energy and default methods")(command)
+    return click.option("--onset-method",
+                        type=click.Choice(ONSET_METHODS, case_sensitive=False),
+                        default="specflux",
+                        show_default=True,
+                        help="Aubio onset detection method")(command)
+
+
+def check_onset_engine(onset_engine: str, onset_method: str):
+    if onset_engine == "numpy":
+        from onsets import numpy_onset_method
+        try:
+            numpy_onset_method(onset_method)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="'--onset-method'")
+
+
+def parse_shard(ctx, param, value: Optional[str]) -> Optional[tuple[int, int]]:
+    if value is None:
+        return None
+    try:
+        shard_index, num_shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("Shards are given as k/N, like 1/4")
+    if not 1 <= shard_index <= num_shards:
+        raise click.BadParameter(f"Shard {shard_index} is not between 1 and {num_shards}")
+    return shard_index, num_shards
+
+
+@click.group(cls=DefaultCommandGroup, default_command="generate")
+def cli() -> None:
+    """Generate new loops by substituting the audio events of source loops. Runs generate if no command is given."""
+
+
+@cli.command("generate")
 @click.option("--number-of-seqs", "-n",
               type=click.IntRange(1, 1000, clamp=True),
               default=1,
               show_default=True,
               help="Number of sequences to generate")
+@click.option("--variations-per-source",
+              type=click.IntRange(1, 1000),
+              default=1,
+              show_default=True,
+              help="Number of outputs generated from the source clip of every sequence. The source clip is analysed "
+                   "once, and every variation draws its own substitutions. Variations are written as "
+                   "<prefix>-<sequence>-<variation>")
 @click.option("--generation-depth", "-d",
               type=click.IntRange(1, 10, clamp=True),
               default=1,
@@ -57,22 +127,14 @@ MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one s
               is_flag=True,
               help="Trim audio snippets to the nearest transient")
 @click.option("--one-shot-mode",
-              type=click.Choice(["long", "true", "false"], case_sensitive=False),
+              type=click.Choice(ONE_SHOT_MODES, case_sensitive=False),
               default="false",
               show_default=True,
               help="Use one shots instead of loops as substitutions for loop generation. If long is specified, the "
                    "special LongOneShotMode is enabled, which extracts several shorter one shots from longer sustained "
                    "one shot sounds.")
 @click.option('--strategy',
-              type=click.Choice(
-                  [
-                      "Interleave",
-                      "InterleavedShuffle",
-                      "InterleaveInPlace",
-                      "ShuffleByDuration",
-                      "ShuffleByPitch"
-                  ],
-                  case_sensitive=False),
+              type=click.Choice(STRATEGIES, case_sensitive=False),
               default="ShuffleByDuration",
               show_default=True,
               help="Strategy for generating audio sequences"
@@ -84,6 +146,10 @@ MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one s
               is_flag=True,
               help="Normalize durations of candidates so that they fall within the same range as the source "
                    "durations, thus making for better matches with the source event durations")
+@click.option("--no-duration-tie-break",
+              is_flag=True,
+              help="ShuffleByPitch: match on exact pitch only, instead of matching events within the same semitone "
+                   "by duration")
 @click.option("--min-duration",
               type=click.IntRange(1, SPLIT_THRESHOLD_IN_SECONDS, clamp=True),
               default=4,
@@ -92,33 +158,21 @@ MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one s
               type=click.IntRange(2, SPLIT_THRESHOLD_IN_SECONDS * 2, clamp=True),
               default=7,
               help="Maximum duration of extracted audio clips in seconds")
-@click.option("--onset-method",
-              type=click.Choice(
-                  [
-                      "default",
-                      "energy",
-                      "hfc",
-                      "complex",
-                      "phase",
-                      "specdiff",
-                      "kl",
-                      "mkl",
-                      "specflux"
-                  ],
-                  case_sensitive=False),
-              default="specflux",
-              show_default=True,
-              help="Aubio onset detection method")
+@onset_method_option
 @click.option("--file-selection-method",
               default="random",
               show_default=True,
-              type=click.Choice(
-                  [
-                      "random",
-                      "sequential"
-                  ],
-                  case_sensitive=False),
+              type=click.Choice(FILE_SELECTION_METHODS, case_sensitive=False),
               help="Method for selecting source audio files")
+@click.option("--file-weighting",
+              type=click.Choice(FILE_WEIGHTINGS, case_sensitive=False),
+              default="uniform",
+              show_default=True,
+              help="How likely every file is to be picked when files are selected randomly. duration favours longer "
+                   "files, folder picks every folder equally often however many files it holds")
+@click.option("--avoid-repeats",
+              is_flag=True,
+              help="Make files that were already picked for a sequence less likely to be picked again")
 @click.option('--event-counts', '-c',
               multiple=True,
               help="One or more values specifying a sequence of counts. These are used differently depending on the chosen strategy:"
@@ -130,6 +184,85 @@ MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one s
               type=str,
               help="Prefix to add to output files, in addition to the sequence number",
               default="output")
+@cache_options
+@click.option("--index",
+              "index_file",
+              type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path),
+              help="Library index created with the index command. When given, substitutions are drawn from every "
+                   "indexed event instead of from a few randomly decoded files. Not used in one shot modes")
+@click.option("--pcm-cache-size",
+              type=click.IntRange(0, None),
+              default=0,
+              show_default=True,
+              help="Decode compressed files like MP3s once to raw samples in the pcm folder of --cache-dir and read "
+                   "them from there, up to this many megabytes. Least recently used files are evicted first. 0 "
+                   "disables the PCM cache")
+@click.option("--jobs", "-j",
+              type=click.IntRange(1, None),
+              default=1,
+              show_default=True,
+              help="Number of worker processes used to generate sequences in parallel. The output for a given seed is "
+                   "the same regardless of the number of workers")
+@click.option("--prefetch",
+              type=click.IntRange(0, 16, clamp=True),
+              default=1,
+              show_default=True,
+              help="Number of sequences to load ahead on a background thread while the current one is matched and the "
+                   "previous one is written. 0 runs every stage strictly in turn. Only used with a single job")
+@click.option("--batch",
+              "batch_file",
+              type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help="Run the sequences as a batch recorded in this SQLite file, which lists the seed, source file and "
+                   "parameters of every sequence and which ones are done. Running the same command again resumes the "
+                   "batch and skips finished sequences. Several machines can work on one batch on shared storage")
+@click.option("--shard",
+              metavar="K/N",
+              callback=parse_shard,
+              help="Only generate the sequences of shard k of N, given as k/N, which are those whose number modulo N "
+                   "is k - 1. Requires --batch")
+@click.option("--bit-depth",
+              type=click.Choice(list(OUTPUT_BIT_DEPTHS)),
+              default="16",
+              show_default=True,
+              help="Bit depth of the output files. 32 writes floating point samples")
+@click.option("--tail-ms",
+              type=click.IntRange(0, 2000, clamp=True),
+              default=0,
+              show_default=True,
+              help="Let every event ring on for this many milliseconds past its slot, mixed with the events that "
+                   "follow it, instead of cutting it off at the next onset")
+@click.option("--fade-shape",
+              type=click.Choice(FADE_SHAPES, case_sensitive=False),
+              default="power",
+              show_default=True,
+              help="Shape of the fades applied to every event. power fades in linearly and fades out along a steep "
+                   "curve, equal_power keeps the loudness constant across overlapping tails")
+@click.option("--render-chunk-seconds",
+              type=click.IntRange(0, None),
+              default=0,
+              show_default=True,
+              help="Render and write the output in chunks of this many seconds, so memory use stays flat for very "
+                   "long renders. 0 renders every output in one piece")
+@click.option("--sample-rate",
+              type=click.IntRange(8000, 192000),
+              default=None,
+              help="Sample rate of the output files. Source and substitution audio at other rates is resampled to "
+                   "it. Defaults to the rate of each source clip")
+@click.option("--no-manifest",
+              is_flag=True,
+              help=f"Do not read or write the {MANIFEST_FILENAME} file that caches the length and format of every "
+                   f"audio file in the source and substitution directories")
+@click.option("--skip-short-files",
+              is_flag=True,
+              help="Skip source and substitution files that are shorter than --min-duration")
+@click.option("--profile",
+              is_flag=True,
+              help="Time every stage of the generation and report wall time, throughput and memory use per stage and "
+                   "per sequence")
+@click.option("--profile-output",
+              type=click.Path(dir_okay=False, writable=True, path_type=pathlib.Path),
+              help="Write the profiled spans to this file. Files ending in .jsonl get one JSON object per line, "
+                   "anything else is written in the Chrome trace event format")
 @click.option('--log-level', '-l',
               type=click.Choice(
                   [
@@ -141,6 +274,7 @@ MAX_NUMBER_OF_SLICES = 100 # Max number of slices to extract from a single one s
                   case_sensitive=False),
               default="ERROR")
 def beat_shuffler(number_of_seqs: int,
+                  variations_per_source: int,
                   generation_depth: int,
                   substitution_dir: str,
                   output: str,
@@ -151,223 +285,271 @@ def beat_shuffler(number_of_seqs: int,
                   strategy: str,
                   recurse_sub_dirs: bool,
                   normalize_durations: bool,
+                  no_duration_tie_break: bool,
                   min_duration: int,
                   max_duration: int,
                   onset_method: str,
+                  onset_engine: str,
                   file_selection_method: str,
+                  file_weighting: str,
+                  avoid_repeats: bool,
                   # event_selection_method: str,
                   event_counts: List[int],
                   output_prefix: str,
+                  cache_dir: pathlib.Path,
+                  no_cache: bool,
+                  cache_size: int,
+                  index_file: Optional[pathlib.Path],
+                  pcm_cache_size: int,
+                  jobs: int,
+                  prefetch: int,
+                  batch_file: Optional[pathlib.Path],
+                  shard: Optional[tuple[int, int]],
+                  bit_depth: str,
+                  tail_ms: int,
+                  fade_shape: str,
+                  render_chunk_seconds: int,
+                  sample_rate: Optional[int],
+                  no_manifest: bool,
+                  skip_short_files: bool,
+                  profile: bool,
+                  profile_output: Optional[pathlib.Path],
                   log_level: str) -> None:
-    logger = Logger(-1 if log_level == "NONE" else 0 if log_level == "INFO" else 1 if log_level == "WARNING" else 2)
+    """Generate new loops from the audio files in the source and substitution directories."""
+    check_onset_engine(onset_engine, onset_method)
+    if shard is not None and batch_file is None:
+        raise click.BadParameter("--shard requires --batch", param_hint="'--shard'")
+    logger = Logger(logLevel=get_log_level(log_level), profile=profile)
     click.echo(f"Iterating all audio files in folder {source_dir} with seed {seed}")
     logger.log(f"Using strategy {strategy}")
-    rng = np.random.default_rng() if seed == -1 else np.random.default_rng(seed)
-    file_chooser = FileChooser(rng, file_selection_method) 
-    source_path = pathlib.Path(source_dir)
-    source_files = get_audio_files(source_path, recurse_sub_dirs)
-    substitution_path = pathlib.Path(substitution_dir) if substitution_dir else source_path
-    substitution_files = get_audio_files(substitution_path, recurse_sub_dirs)
+    source_infos, substitution_infos = scan_library(source_dir, substitution_dir, recurse_sub_dirs, not no_manifest,
+                                                    logger)
+    if skip_short_files:
+        source_infos = [info for info in source_infos if info.duration >= min_duration]
+        substitution_infos = [info for info in substitution_infos if info.duration >= min_duration]
+    source_files = [info.path for info in source_infos]
+    substitution_files = [info.path for info in substitution_infos]
 
     logger.log(f"Got the following for chunk {event_counts}")
 
     if not source_files:
         click.echo("No audio files were found in the supplied source directory")
         exit(0)
+    use_library_index = index_file is not None and one_shot_mode == "false"
+    if not substitution_files and not use_library_index:
+        click.echo("No audio files were found in the supplied substitution directory")
+        exit(0)
+    if index_file is not None and not use_library_index:
+        logger.log("Library index is not used in one shot modes", logger.WARNING)
+
+    settings = GenerationSettings(
+        source_files=source_files,
+        substitution_files=substitution_files,
+        file_durations={str(info.path): info.duration for info in source_infos + substitution_infos},
+        output=pathlib.Path(output),
+        output_prefix=output_prefix,
+        generation_depth=generation_depth,
+        min_duration=min_duration,
+        max_duration=max_duration,
+        trim=trim,
+        one_shot_mode=one_shot_mode,
+        strategy=strategy,
+        onset_method=onset_method,
+        onset_engine=onset_engine.lower(),
+        file_selection_method=file_selection_method,
+        file_weighting=file_weighting.lower(),
+        avoid_repeats=avoid_repeats,
+        options={
+            "normalize_durations": normalize_durations,
+            "duration_tie_break": not no_duration_tie_break,
+            "event_counts": event_counts
+        },
+        cache_dir=None if no_cache else cache_dir,
+        cache_size=cache_size,
+        pcm_cache_dir=cache_dir / "pcm" if pcm_cache_size > 0 else None,
+        pcm_cache_size=pcm_cache_size,
+        index_file=index_file if use_library_index else None,
+        bit_depth=OUTPUT_BIT_DEPTHS[bit_depth],
+        tail_ms=tail_ms,
+        fade_shape=fade_shape.lower(),
+        render_chunk_seconds=render_chunk_seconds,
+        sample_rate=sample_rate,
+        variations_per_source=variations_per_source,
+        log_level=logger.logLevel,
+        profile=profile
+    )
+
+    import generation
+    from batch_manifest import BatchError
+    from library_index import LibraryIndexError
+    try:
+        generation.run_generation(settings, number_of_seqs, seed, logger, jobs, prefetch, batch_file, shard)
+    except (BatchError, LibraryIndexError) as e:
+        raise click.UsageError(str(e))
+    if profile:
+        click.echo(logger.report())
+        if profile_output is not None:
+            logger.write_trace(str(profile_output))
+
+
+def get_log_level(log_level: str) -> int:
+    if log_level == "NONE":
+        return 3
+    return ["INFO", "WARNING", "ERROR"].index(log_level)
+
+
+@cli.command("index")
+@click.option("--substitution-dir", "-sub",
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, path_type=pathlib.Path),
+              default=".",
+              show_default=True,
+              help="Path to directory containing the audio files to index")
+@click.option("--recurse-sub-dirs",
+              is_flag=True,
+              help="Recurse into subdirectories when fetching substitution audio files")
+@click.option("--index-file",
+              type=click.Path(file_okay=True, dir_okay=False, writable=True, path_type=pathlib.Path),
+              help=f"Where to write the index  [default: <substitution-dir>/{DEFAULT_INDEX_FILENAME}]")
+@onset_method_option
+@cache_options
+def index_library(substitution_dir: pathlib.Path,
+                  recurse_sub_dirs: bool,
+                  index_file: Optional[pathlib.Path],
+                  onset_method: str,
+                  onset_engine: str,
+                  cache_dir: pathlib.Path,
+                  no_cache: bool,
+                  cache_size: int) -> None:
+    """Analyse every audio file in the substitution directory once and store the features of each event."""
+    check_onset_engine(onset_engine, onset_method)
+    substitution_files = get_audio_files(substitution_dir, recurse_sub_dirs)
     if not substitution_files:
         click.echo("No audio files were found in the supplied substitution directory")
         exit(0)
+    from analysis_cache import AnalysisCache
+    from library_index import build_library_index
+    analysis_cache = None if no_cache else AnalysisCache(cache_dir, cache_size * 1024 * 1024)
+    with click.progressbar(length=len(substitution_files), label="Indexing audio files") as progress:
+        library_index = build_library_index(substitution_files, onset_method, analysis_cache,
+                                            lambda filename: progress.update(1), onset_engine.lower())
+    if len(library_index.files) == 0:
+        click.echo("None of the audio files in the supplied substitution directory could be analysed")
+        exit(0)
+    index_file = index_file or pathlib.Path(substitution_dir, DEFAULT_INDEX_FILENAME)
+    library_index.save(index_file)
+    click.echo(f"Indexed {len(library_index)} events from {len(library_index.files)} files into {index_file}")
+
+
+@cli.command("serve")
+@click.option("--source-dir", "-src",
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, path_type=pathlib.Path),
+              default=".",
+              show_default=True,
+              help="Path to directory containing source audio files")
+@click.option("--substitution-dir", "-sub",
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, path_type=pathlib.Path),
+              help="Path to directory containing substitution audio files. If left unspecified, the source "
+                   "directory is used for substitutions as well")
+@click.option("--recurse-sub-dirs",
+              is_flag=True,
+              help="Recurse into subdirectories when fetching audio files")
+@click.option("--output", "-o",
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True, path_type=pathlib.Path),
+              default=".",
+              show_default=True,
+              help="Path to the directory every request writes its outputs to")
+@click.option("--index",
+              "index_file",
+              type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path),
+              help="Library index created with the index command, used by requests that are not in a one shot mode")
+@onset_method_option
+@cache_options
+@click.option("--pcm-cache-size",
+              type=click.IntRange(0, None),
+              default=0,
+              show_default=True,
+              help="Decode compressed files once to raw samples in the pcm folder of --cache-dir, up to this many "
+                   "megabytes. 0 disables the PCM cache")
+@click.option("--no-manifest",
+              is_flag=True,
+              help=f"Do not read or write the {MANIFEST_FILENAME} file")
+@click.option("--host",
+              default="127.0.0.1",
+              show_default=True,
+              help="Address to listen on")
+@click.option("--port",
+              type=click.IntRange(0, 65535),
+              default=8765,
+              show_default=True,
+              help="Port to listen on. 0 picks a free port")
+@click.option("--socket",
+              "socket_path",
+              type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help="Listen on this Unix socket instead of a TCP port")
+@click.option('--log-level', '-l',
+              type=click.Choice(["NONE", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+              default="ERROR")
+def serve_requests(source_dir: pathlib.Path,
+                   substitution_dir: Optional[pathlib.Path],
+                   recurse_sub_dirs: bool,
+                   output: pathlib.Path,
+                   index_file: Optional[pathlib.Path],
+                   onset_method: str,
+                   onset_engine: str,
+                   cache_dir: pathlib.Path,
+                   no_cache: bool,
+                   cache_size: int,
+                   pcm_cache_size: int,
+                   no_manifest: bool,
+                   host: str,
+                   port: int,
+                   socket_path: Optional[pathlib.Path],
+                   log_level: str) -> None:
+    """Keep the scanned library, analyses and decoded audio in memory and generate loops for JSON requests.
+
+    POST a JSON object to /generate with any of seed, number_of_seqs, return_audio and the generation settings, like
+    strategy or one_shot_mode. GET /stats reports the state of the caches."""
+    check_onset_engine(onset_engine, onset_method)
+    logger = Logger(logLevel=get_log_level(log_level))
+    source_infos, substitution_infos = scan_library(source_dir, substitution_dir, recurse_sub_dirs, not no_manifest,
+                                                    logger)
+    if not source_infos:
+        click.echo("No audio files were found in the supplied source directory")
+        exit(0)
+    settings = GenerationSettings(
+        source_files=[info.path for info in source_infos],
+        substitution_files=[info.path for info in substitution_infos],
+        file_durations={str(info.path): info.duration for info in source_infos + substitution_infos},
+        output=output,
+        onset_method=onset_method,
+        onset_engine=onset_engine.lower(),
+        cache_dir=None if no_cache else cache_dir,
+        cache_size=cache_size,
+        pcm_cache_dir=cache_dir / "pcm" if pcm_cache_size > 0 else None,
+        pcm_cache_size=pcm_cache_size,
+        index_file=index_file,
+        log_level=logger.logLevel
+    )
+    import generation
+    import server
+    from AudioFilePool import shared_pool
+    generation.configure_pool(settings)
+    requests_served = 0
+
+    def generate(request: dict) -> dict:
+        nonlocal requests_served
+        response = generation.generate_request(settings, request, logger)
+        requests_served += 1
+        return response
+
+    def stats() -> dict:
+        return {"requests": requests_served,
+                "source_files": len(settings.source_files),
+                "substitution_files": len(settings.substitution_files),
+                "pool": shared_pool.stats()}
 
-    options = {
-        "normalize_durations": normalize_durations,
-        "event_counts": event_counts
-    }
-
-    for i in range(number_of_seqs):
-        selected_file = str(file_chooser.choose(source_files))
-        click.echo(f"Selected file {selected_file}")
-        source_clip = get_audio_clip(selected_file, rng.random(),
-                                     rng.integers(min_duration, high=max_duration), trim, onset_method)
-        click.echo(f"Got clip with {len(source_clip.events)} events")
-        substitution_clips = get_substitution_clips(substitution_files, generation_depth, min_duration, max_duration,
-                                                    one_shot_mode, source_clip, file_chooser, trim)
-        result_events = generate_sequence(strategy, source_clip, substitution_clips, options)
-        result = AudioClip(result_events)
-        write_audio_clip(str(pathlib.Path(output, f"{output_prefix}-{i}")), result)
-
-
-def generate_sequence(strategy: str,
-                      source_clip: AudioClip,
-                      substitution_clips: list[AudioClip],
-                      options: dict) -> list[AudioEvent]:
-    if strategy == "ShuffleByDuration":
-        return strategies.shuffle_by_duration(source_clip, substitution_clips,
-                                              normalize_durations=options["normalize_durations"])
-    if strategy == "Interleave":
-        return strategies.interleave(source_clip, substitution_clips, event_counts=options["event_counts"])
-
-    if strategy == "InterleaveInPlace":
-        return strategies.interleave_in_place(source_clip, substitution_clips, event_counts=options["event_counts"])
-
-    return []
-
-
-def get_substitution_clips(substitution_files,
-                           generation_depth: int,
-                           min_duration: int,
-                           max_duration: int,
-                           one_shot_mode: str,
-                           source_clip: AudioClip,
-                           file_chooser: FileChooser,
-                           trim: bool) -> list[AudioClip]:
-
-    clips = list()
-    if one_shot_mode == "true":
-        for _ in range(generation_depth):
-            # num_events = rng.integers(source_events_length, source_events_length + round(source_events_length / 2))
-            events: List[AudioEvent] = []
-            for event in source_clip.events:
-                filename: str = str(file_chooser.choose(substitution_files))
-                events.append(get_audio_event(filename, 0, 44100, event.start, 
-                                              event.duration, False))
-            clips.append(AudioClip(events, source_clip.sample_rate))
-    elif one_shot_mode == "long":
-        for _ in range(generation_depth):
-            events: List[AudioEvent] = []
-            cur_event_ix = 0
-            while cur_event_ix < len(source_clip.events):
-                filename: str = str(file_chooser.choose(substitution_files))
-                with AudioFile(filename) as file_to_slice:
-                    file_length_samples = file_to_slice.frames
-                # Long one shot mode is only enabled for files longer than a certain threshold
-                if file_length_samples > ONE_SHOT_SLICE_THRESHOLD_SAMPLES:
-                    num_slices = len(source_clip.events)
-                    slice_length = int(math.floor(file_length_samples / num_slices))
-                    if slice_length < SHORTEST_ONE_SHOT:
-                        slice_length = SHORTEST_ONE_SHOT
-                        num_slices = int(math.floor(file_length_samples / SHORTEST_ONE_SHOT))
-                    num_slices = min(len(source_clip.events) - cur_event_ix, num_slices)
-                    events.extend(get_slices(filename, cur_event_ix, num_slices, slice_length, source_clip))
-                    cur_event_ix += len(events)
-                    
-                else:
-                    if cur_event_ix >= len(source_clip.events):
-                        break
-                    ev = get_audio_event(filename, 
-                                         0, 
-                                         44100, 
-                                         source_clip.events[cur_event_ix].start,
-                                         source_clip.events[cur_event_ix].duration, 
-                                         False)
-                    events.append(ev)
-                    cur_event_ix += 1
-            clips.append(AudioClip(events, source_clip.sample_rate))
-    else:    
-        for _ in range(generation_depth):
-            file: str = str(file_chooser.choose(substitution_files))
-            duration = file_chooser.rng.integers(min_duration, high=max_duration)
-            clips.append(get_audio_clip(file, file_chooser.rng.random(), duration, trim))
-
-    return clips
-
-
-def get_slices(filename: str, cur_event_ix: int, num_slices: int, slice_length: int, source_clip: AudioClip) -> List[AudioEvent]:
-    slices: List[AudioEvent] = []
-    for i in range(min(num_slices, MAX_NUMBER_OF_SLICES)):
-        if cur_event_ix >= len(source_clip.events):
-            break
-        start_time = i * slice_length
-        slices.append(get_audio_event(filename,
-                                      start_time,
-                                      start_time + min(44100, slice_length),
-                                      source_clip.events[cur_event_ix].start,
-                                      source_clip.events[cur_event_ix].duration,
-                                      i > 0))
-        cur_event_ix += 1
-    return slices
-
-
-def get_audio_event(filename: str,
-                    start_time_samples: int,
-                    end_time_samples: int,
-                    map_to_onset_samples: int,
-                    map_to_duration_samples: int,
-                    should_fade_in: bool) -> AudioEvent:
-    samples = []
-    with AudioFile(filename) as file:
-        if start_time_samples >= file.frames:
-            start_time_samples = 0
-        if end_time_samples >= file.frames:
-            end_time_samples = file.frames - 1
-        file.seek(start_time_samples)
-        duration = end_time_samples - start_time_samples
-        samples.extend(file.read(duration)[0, :])
-    return AudioEvent(map_to_onset_samples, map_to_duration_samples, 0, samples, 0, should_fade_in)
-
-# Could be nice to give audio events generated from one shots timing information (onset, duration), since it could be 
-# useful for processes like remapping events from substitution clips into event slots from a source_clip
-
-def get_audio_clip(filename: str,
-                   start_offset_fraction: float,
-                   duration_secs: int,
-                   trim: bool,
-                   aubio_method: str = "hfc") -> AudioClip:
-    win_s = 512  # fft size
-    hop_s = win_s // 2  # hop size
-    onsets = []  # contains sample indexes to all onsets in the current clip, including start and end points
-    all_samples = []
-    samples_read = 0
-    with AudioFile(filename) as file:
-        duration_secs = helpers.clamp(duration_secs, 0, file.duration)
-        if file.duration < SPLIT_THRESHOLD_IN_SECONDS:
-            duration_secs = file.duration
-            trim = False
-        samplerate = file.samplerate
-        start_offset = helpers.clamp(
-            int(file.duration * start_offset_fraction),
-            0,
-            file.duration - duration_secs
-        )
-        onset_detector = aubio.onset(aubio_method, samplerate=file.samplerate, hop_size=hop_s, buf_size=win_s)
-        start_offset_samples = int(start_offset * file.samplerate)
-        num_samples = int(duration_secs * file.samplerate)
-        file.seek(start_offset_samples)
-        while samples_read < num_samples:
-            samples = file.read(hop_s)
-            samples_read += len(samples[0, :])
-            # we only keep left channel
-            all_samples.extend(samples[0, :])
-            if len(samples[0, :]) < hop_s:
-                break
-            if onset_detector(samples[0, :]):
-                onsets.append(onset_detector.get_last())
-    onsets.insert(0, 0)  # First onset always starts at 0
-    onsets.append(samples_read)  # Last onset = end of clip
-    events: List[AudioEvent] = list()
-    for ix, onset in enumerate(onsets[0:-1]):
-        duration = onsets[ix + 1] - onset
-        events.append(AudioEvent(onset, duration, 0, all_samples[onset:onset + duration], 0, True))
-    if trim:
-        events = events[1:-1]
-    return AudioClip(events=events, sample_rate=samplerate)
-
-
-def write_audio_clip(filename: str, clip: AudioClip):
-    with AudioFile(f"{filename}.wav", "w", samplerate=clip.sample_rate, num_channels=clip.num_channels) as f:
-        for event in clip.events:
-            f.write(event.audio_data)
-
-
-def get_audio_files(path, recurse) -> List[pathlib.Path]:
-    if recurse:
-        return [p for pattern in ["*.wav", "*.mp3", "*.aiff"]
-                for p in path.rglob(pattern)
-                if not p.name.startswith('._')]
-    else:
-        return [p for pattern in ["*.wav", "*.mp3", "*.aiff"]
-                for p in path.glob(pattern)
-                if not p.name.startswith('._')]
+    server.serve(generate, stats, logger, host, port, socket_path)
 
 
 if __name__ == "__main__":
-    beat_shuffler()
+    cli()
@@ -0,0 +1,170 @@
+import functools
+from typing import Callable, List
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+NUMPY_ONSET_METHODS = ["specflux", "hfc", "energy"]
+# Peak picking thresholds and log compression of the magnitudes, matched to the defaults of the aubio methods
+ONSET_THRESHOLDS = {"specflux": 0.18, "hfc": 0.058, "energy": 0.3}
+ONSET_COMPRESSION = {"specflux": 10.0, "hfc": 1.0, "energy": 0.0}
+# The adaptive threshold of a frame is computed over this many frames before and after it
+PEAK_PICKING_PRE_FRAMES = 5
+PEAK_PICKING_POST_FRAMES = 1
+# Biquad low pass every threshold window is smoothed with in both directions, as aubio does
+SMOOTHING_FILTER = ([0.16, 0.32, 0.16], [1, 0.2348, 0])
+# Onsets are reported this many hops before the hop they were picked in, which makes up for the latency of the STFT
+# and the peak picker
+ONSET_DELAY_HOPS = 4.3
+MINIMUM_INTER_ONSET_SECONDS = 0.05
+SILENCE_THRESHOLD_DB = -70
+# Adaptive whitening of the spectral flux: every bin is divided by its recent peak, which decays by 60 dB over this many
+# seconds and is never below the floor
+WHITENING_RELAX_SECONDS = 100
+WHITENING_FLOOR = 1.0
+# Running maxima over frames are computed for blocks of this many frames side by side, which is several times faster
+# than accumulating over all frames in one call
+RUNNING_MAXIMUM_BLOCK_FRAMES = 64
+
+
+@functools.lru_cache(maxsize=1)
+def get_rfft() -> Callable:
+    # scipy.fft is faster for batches of frames, but slow to import, so it is only imported once onsets are detected
+    try:
+        from scipy.fft import rfft
+    except ImportError:
+        return np.fft.rfft
+    return rfft
+
+
+def numpy_onset_method(method: str) -> str:
+    # "default" is hfc, as it is for aubio
+    method = "hfc" if method == "default" else method
+    if method not in NUMPY_ONSET_METHODS:
+        raise ValueError(f"The numpy onset engine supports {', '.join(NUMPY_ONSET_METHODS)}, not {method}")
+    return method
+
+
+def running_maximum(values: np.ndarray) -> np.ndarray:
+    # Running maximum over the first axis: within blocks first, then every block is raised to the maximum of the
+    # blocks before it
+    num_frames = len(values)
+    num_blocks = -(-num_frames // RUNNING_MAXIMUM_BLOCK_FRAMES)
+    blocks = np.pad(values, ((0, num_blocks * RUNNING_MAXIMUM_BLOCK_FRAMES - num_frames), (0, 0)))
+    blocks = blocks.reshape(num_blocks, RUNNING_MAXIMUM_BLOCK_FRAMES, -1)
+    for i in range(1, RUNNING_MAXIMUM_BLOCK_FRAMES):
+        np.maximum(blocks[:, i], blocks[:, i - 1], out=blocks[:, i])
+    block_maxima = np.maximum.accumulate(blocks[:, -1], axis=0)
+    np.maximum(blocks[1:], block_maxima[:-1, np.newaxis], out=blocks[1:])
+    return blocks.reshape(num_blocks * RUNNING_MAXIMUM_BLOCK_FRAMES, -1)[:num_frames]
+
+
+def whiten(magnitudes: np.ndarray, samplerate: int, hop_s: int) -> np.ndarray:
+    # The decaying peak of every bin is a running maximum in the log domain, so no loop over frames is needed:
+    # log peak[n] = n log d + max over k <= n of (log mag[k] - k log d)
+    log_decay = np.log(0.001) * hop_s / (WHITENING_RELAX_SECONDS * samplerate)
+    ramp = (np.arange(len(magnitudes), dtype=np.float32) * np.float32(log_decay))[:, np.newaxis]
+    log_peaks = running_maximum(np.log(np.maximum(magnitudes, WHITENING_FLOOR)) - ramp) + ramp
+    return magnitudes * np.exp(-np.maximum(log_peaks, np.log(WHITENING_FLOOR)))
+
+
+def novelty(magnitudes: np.ndarray, method: str, samplerate: int, hop_s: int) -> np.ndarray:
+    if method == "specflux":
+        magnitudes = whiten(magnitudes, samplerate, hop_s)
+    if ONSET_COMPRESSION[method] > 0:
+        magnitudes = np.log1p(ONSET_COMPRESSION[method] * magnitudes)
+    if method == "hfc":
+        return magnitudes @ np.arange(1, magnitudes.shape[1] + 1, dtype=np.float32)
+    if method == "energy":
+        return np.square(magnitudes).sum(axis=1)
+    flux = np.diff(magnitudes, axis=0, prepend=np.zeros_like(magnitudes[:1]))
+    return np.maximum(flux, 0).sum(axis=1)
+
+
+@functools.lru_cache(maxsize=1)
+def smoothing_matrix() -> np.ndarray:
+    # Filtering a window forwards and backwards from a zero state is linear, so it is a matrix product. The matrix is
+    # built by filtering the unit vectors
+    (b0, b1, b2), (_, a1, a2) = SMOOTHING_FILTER
+
+    def biquad(x):
+        y = np.zeros_like(x)
+        for n in range(len(x)):
+            y[n] = b0 * x[n] + (b1 * x[n - 1] - a1 * y[n - 1] if n >= 1 else 0) + \
+                (b2 * x[n - 2] - a2 * y[n - 2] if n >= 2 else 0)
+        return y
+
+    size = PEAK_PICKING_PRE_FRAMES + PEAK_PICKING_POST_FRAMES + 1
+    return np.array([biquad(biquad(unit)[::-1])[::-1] for unit in np.eye(size)], dtype=np.float32)
+
+
+def pick_peaks(novelty_curve: np.ndarray, threshold: float) -> tuple[np.ndarray, np.ndarray]:
+    """A frame is an onset if it is a local maximum that exceeds the median plus a fraction of the mean of the frames
+    around it. Returns the frames the peaks are picked in, two frames after the peaks themselves, and the fractional
+    position of each peak relative to its frame"""
+    windows = sliding_window_view(np.pad(novelty_curve, (PEAK_PICKING_PRE_FRAMES + PEAK_PICKING_POST_FRAMES, 0)),
+                                  PEAK_PICKING_PRE_FRAMES + PEAK_PICKING_POST_FRAMES + 1)
+    smoothed = windows @ smoothing_matrix()
+    thresholded = smoothed[:, PEAK_PICKING_PRE_FRAMES] - np.median(smoothed, axis=1) - \
+        threshold * smoothed.mean(axis=1)
+    before, peak, after = np.pad(thresholded, (2, 0))[:-2], np.pad(thresholded, (1, 0))[:-1], thresholded
+    frames = np.flatnonzero((peak > 0) & (peak > before) & (peak > after))
+    curvature = before[frames] - 2 * peak[frames] + after[frames]
+    offsets = 1 + 0.5 * (before[frames] - after[frames]) / np.where(curvature == 0, 1, curvature)
+    return frames, offsets
+
+
+def enforce_minimum_interval(onsets: np.ndarray, minimum_interval: int) -> np.ndarray:
+    # Only loops over the onsets, which are few compared to the frames
+    kept = []
+    for onset in onsets.tolist():
+        if not kept or onset > kept[-1] + minimum_interval:
+            kept.append(onset)
+    return np.array(kept, dtype=np.int64)
+
+
+def detect_onsets(samples: np.ndarray, samplerate: int, method: str, win_s: int, hop_s: int) -> np.ndarray:
+    """Finds the onsets in a mono signal with an STFT over the whole signal. Returns the onsets in samples"""
+    return detect_onsets_batch([samples], samplerate, method, win_s, hop_s)[0]
+
+
+def detect_onsets_batch(clips: List[np.ndarray],
+                        samplerate: int,
+                        method: str,
+                        win_s: int,
+                        hop_s: int) -> List[np.ndarray]:
+    """Like detect_onsets for many mono signals of the same sample rate, with a single FFT call for all of them"""
+    method = numpy_onset_method(method)
+    clips = [np.asarray(clip, dtype=np.float32) for clip in clips]
+    frame_counts = [len(clip) // hop_s for clip in clips]
+    frames = [sliding_window_view(np.concatenate([np.zeros(win_s - hop_s, dtype=np.float32),
+                                                  clip[:num_frames * hop_s]]), win_s)[::hop_s]
+              for clip, num_frames in zip(clips, frame_counts) if num_frames > 0]
+    # aubio uses the periodic Hann window
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(win_s) / win_s)).astype(np.float32)
+    magnitudes = np.abs(get_rfft()(np.concatenate(frames) * window, axis=1)).astype(np.float32, copy=False) if frames \
+        else np.zeros((0, win_s // 2 + 1), dtype=np.float32)
+    minimum_interval = round(MINIMUM_INTER_ONSET_SECONDS * samplerate)
+    delay = int(ONSET_DELAY_HOPS * hop_s)
+    results = []
+    start = 0
+    for clip, num_frames in zip(clips, frame_counts):
+        clip_magnitudes = magnitudes[start:start + num_frames]
+        start += num_frames
+        if num_frames == 0:
+            results.append(np.zeros(0, dtype=np.int64))
+            continue
+        hop_levels = 10 * np.log10(np.maximum(np.square(clip[:num_frames * hop_s]).reshape(num_frames, hop_s)
+                                              .mean(axis=1), 1e-20))
+        frames, offsets = pick_peaks(novelty(clip_magnitudes, method, samplerate, hop_s), ONSET_THRESHOLDS[method])
+        # Like aubio, a peak is dropped when the hop it is picked in is silent, and a signal that does not start in
+        # silence has an onset at its start
+        sounding = hop_levels[frames] > SILENCE_THRESHOLD_DB
+        positions = frames[sounding] * hop_s + np.round(offsets[sounding] * hop_s).astype(np.int64)
+        if hop_levels[0] > SILENCE_THRESHOLD_DB:
+            positions = np.concatenate([[delay], positions[positions > delay + minimum_interval]])
+        else:
+            positions = positions[positions > minimum_interval]
+        onsets = enforce_minimum_interval(positions, minimum_interval) - delay
+        results.append(onsets[onsets >= 0])
+    return results
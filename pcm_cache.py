@@ -0,0 +1,106 @@
+import os
+import pathlib
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from pedalboard_native.io import AudioFile
+
+from Logger import span
+from analysis_cache import AnalysisCache, evict_least_recently_used
+
+PCM_FILE_SUFFIX = ".f32"
+# Bump whenever the layout of the PCM files changes, so that stale entries are not picked up
+PCM_VERSION = 2
+# Formats that have to be decoded from an earlier position to seek, which makes reading random ranges slow
+COMPRESSED_EXTENSIONS = {".mp3", ".ogg", ".flac", ".m4a"}
+TRANSCODE_BLOCK_SIZE = 44100 * 10
+
+
+def is_compressed(filename: str) -> bool:
+    return pathlib.Path(filename).suffix.lower() in COMPRESSED_EXTENSIONS
+
+
+@dataclass
+class PcmCache:
+    """Decodes compressed files once to raw float32 files with interleaved channels, which are then memory mapped for
+    every later read"""
+    cache_dir: pathlib.Path
+    max_bytes: int = 2048 * 1024 * 1024
+
+    def __post_init__(self):
+        self.cache_dir = pathlib.Path(self.cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def fits(self, num_frames: int, num_channels: int) -> bool:
+        # Files larger than the whole cache would evict themselves, so they are read from the audio file instead
+        return num_frames * num_channels * np.dtype(np.float32).itemsize <= self.max_bytes
+
+    def load(self, filename: str, num_channels: int) -> np.ndarray:
+        # Returns a (channels, frames) view of the mapped file
+        entry = self.cache_dir / f"{AnalysisCache.key(filename, num_channels, PCM_VERSION)}{PCM_FILE_SUFFIX}"
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            self.transcode(filename, entry)
+            self.evict(keep=entry)
+        except OSError:
+            pass
+        try:
+            return self.map(entry, num_channels)
+        except FileNotFoundError:
+            # Evicted by another process since it was found
+            self.transcode(filename, entry)
+            return self.map(entry, num_channels)
+
+    @staticmethod
+    def map(entry: pathlib.Path, num_channels: int) -> np.ndarray:
+        if entry.stat().st_size == 0:
+            return np.zeros((num_channels, 0), dtype=np.float32)
+        return np.memmap(entry, dtype=np.float32, mode="r").reshape(-1, num_channels).T
+
+    def transcode(self, filename: str, entry: pathlib.Path):
+        # Written to a temporary file first so that concurrent readers never map a partially written entry
+        temp_entry = self.cache_dir / f"{entry.stem}.{os.getpid()}.tmp"
+        with AudioFile(filename) as file, open(temp_entry, "wb") as f, span("transcode") as details:
+            while True:
+                block = file.read(TRANSCODE_BLOCK_SIZE)
+                if block.shape[-1] == 0:
+                    break
+                f.write(np.ascontiguousarray(block.T, dtype=np.float32).tobytes())
+                details["samples"] += block.shape[-1]
+        os.replace(temp_entry, entry)
+
+    def evict(self, keep: Optional[pathlib.Path] = None):
+        evict_least_recently_used(self.cache_dir, PCM_FILE_SUFFIX, self.max_bytes, keep)
+
+
+class PcmReader:
+    """Read-only stand-in for an AudioFile over already decoded samples, so cached PCM is read the same way"""
+
+    def __init__(self, samples: np.ndarray, samplerate: float):
+        self.samples = samples
+        self.samplerate = samplerate
+        self.num_channels, self.frames = samples.shape
+        self.duration = self.frames / samplerate
+        self.position = 0
+
+    def seek(self, position: int):
+        self.position = position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, num_frames: int) -> np.ndarray:
+        samples = self.samples[:, self.position:self.position + num_frames]
+        self.position += samples.shape[-1]
+        return samples
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,95 @@
+from typing import Iterator, List, Optional
+
+import numpy as np
+from pedalboard_native.io import AudioFile
+
+import audio_utils
+import fades
+from AudioClip import AudioClip
+from AudioEvent import AudioEvent
+from Logger import span
+
+
+def pack_events(events: List[AudioEvent],
+                sample_rate: int,
+                num_channels: int,
+                tail: int = 0,
+                fade_shape: str = "power") -> tuple[np.ndarray, np.ndarray]:
+    # Copies the audio of all events back to back into one (channels, frames) buffer and fades every event in a single
+    # pass over it. With a tail, an event keeps sounding past its slot and is mixed with the events that follow it.
+    segments = [audio_utils.conform_channels(event.audio_with_tail(tail), num_channels)
+                for event in events]
+    lengths = np.array([segment.shape[-1] for segment in segments], dtype=np.int64)
+    if not segments:
+        return np.zeros((num_channels, 0), dtype=np.float32), lengths
+    packed = np.concatenate(segments, axis=-1, dtype=np.float32)
+    fades.apply_fades(packed, np.cumsum(lengths) - lengths, lengths, [event.should_fade_in for event in events],
+                      sample_rate, fade_shape)
+    return packed, lengths
+
+
+def overlap_add(packed: np.ndarray, lengths: np.ndarray, positions: np.ndarray, length: int) -> np.ndarray:
+    # Adds every packed segment into its slice of a single (channels, length) buffer, which is the only allocation.
+    # Samples outside the buffer are dropped
+    mixed = np.zeros((packed.shape[0], length), dtype=np.float32)
+    segment_starts = np.cumsum(lengths) - lengths
+    for segment_start, segment_length, position in zip(segment_starts.tolist(), np.asarray(lengths).tolist(),
+                                                       np.asarray(positions).tolist()):
+        first = max(position, 0)
+        last = min(position + segment_length, length)
+        if first < last:
+            mixed[:, first:last] += packed[:, segment_start + first - position:segment_start + last - position]
+    return mixed
+
+
+def render_clip(clip: AudioClip, tail: int = 0, fade_shape: str = "power") -> np.ndarray:
+    packed, lengths = pack_events(clip.events, clip.sample_rate, clip.num_channels, tail, fade_shape)
+    positions = np.array([event.start - clip.offset for event in clip.events], dtype=np.int64)
+    return overlap_add(packed, lengths, positions, clip.length)
+
+
+def render_chunks(clip: AudioClip,
+                  chunk_size: int,
+                  tail: int = 0,
+                  fade_shape: str = "power") -> Iterator[np.ndarray]:
+    # Only the events overlapping the current chunk are kept in memory, so memory use does not grow with the length
+    # of the render
+    events = sorted(clip.events, key=lambda event: event.start)
+    active = []
+    next_event = 0
+    for chunk_start in range(0, clip.length, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, clip.length)
+        first_new_event = next_event
+        while next_event < len(events) and events[next_event].start - clip.offset < chunk_end:
+            next_event += 1
+        new_events = events[first_new_event:next_event]
+        packed, lengths = pack_events(new_events, clip.sample_rate, clip.num_channels, tail, fade_shape)
+        active += zip([event.start - clip.offset for event in new_events],
+                      np.split(packed, np.cumsum(lengths)[:-1], axis=-1) if len(new_events) else [])
+        active = [(position, segment) for position, segment in active
+                  if position + segment.shape[-1] > chunk_start]
+        segments = [segment for _, segment in active]
+        yield overlap_add(np.concatenate(segments, axis=-1) if segments
+                          else np.zeros((clip.num_channels, 0), dtype=np.float32),
+                          np.array([segment.shape[-1] for segment in segments], dtype=np.int64),
+                          np.array([position - chunk_start for position, _ in active], dtype=np.int64),
+                          chunk_end - chunk_start)
+
+
+def write_audio_clip(filename: str,
+                     clip: AudioClip,
+                     bit_depth: int = 16,
+                     tail: int = 0,
+                     chunk_size: Optional[int] = None,
+                     fade_shape: str = "power"):
+    with AudioFile(f"{filename}.wav", "w", samplerate=clip.sample_rate, num_channels=clip.num_channels,
+                   bit_depth=bit_depth) as f:
+        if chunk_size:
+            for chunk in render_chunks(clip, chunk_size, tail, fade_shape):
+                with span("write", chunk.shape[-1]):
+                    f.write(chunk)
+            return
+        with span("fade", clip.length):
+            output = render_clip(clip, tail, fade_shape)
+        with span("write", output.shape[-1]):
+            f.write(output)
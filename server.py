@@ -0,0 +1,97 @@
+import json
+import os
+import pathlib
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Optional
+
+import click
+
+from Logger import Logger
+from generation import RequestError
+
+# Largest request body that is read, which is far more than any generation request needs
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    allow_reuse_address = True
+
+
+def make_handler(generate: Callable[[dict], dict], stats: Callable[[], dict], logger: Logger):
+    # Requests are handled one at a time, since generation shares the audio file pool and the caches of the process
+    lock = threading.Lock()
+
+    class GenerationRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/stats":
+                self.send_json(200, stats())
+            else:
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_REQUEST_BYTES:
+                self.send_json(413, {"error": "Request too large"})
+                return
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise RequestError("Request must be a JSON object")
+                with lock:
+                    start = time.perf_counter()
+                    response = generate(request)
+                    response["seconds"] = time.perf_counter() - start
+            except (json.JSONDecodeError, RequestError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                logger.log(f"Generation failed: {e!r}", logger.ERROR)
+                self.send_json(500, {"error": repr(e)})
+                return
+            self.send_json(200, response)
+
+        def send_json(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # Clients of a Unix socket have no address
+            logger.log(f"{self.requestline} {format % args}")
+
+    return GenerationRequestHandler
+
+
+def serve(generate: Callable[[dict], dict],
+          stats: Callable[[], dict],
+          logger: Logger,
+          host: str = "127.0.0.1",
+          port: int = 8765,
+          socket_path: Optional[pathlib.Path] = None):
+    handler = make_handler(generate, stats, logger)
+    if socket_path is not None:
+        if socket_path.exists():
+            os.unlink(socket_path)
+        server = UnixHTTPServer(str(socket_path), handler)
+        address = str(socket_path)
+    else:
+        server = HTTPServer((host, port), handler)
+        address = f"http://{host}:{server.server_port}"
+    click.echo(f"Serving on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and socket_path.exists():
+            os.unlink(socket_path)
@@ -1,36 +1,108 @@
-import click
+from typing import Optional
 
+import numpy as np
+
+import features
 import helpers
 import copy
 
 from AudioClip import AudioClip
 from AudioEvent import AudioEvent
 
+TIMBRE_WEIGHTS = {"rms": 1.0, "peak": 0.5, "spectral_centroid": 1.0, "spectral_flatness": 1.0, "mfcc": 1.0}
+
 
 def shuffle_by_duration(source_clip: AudioClip,
                         substitution_clips: list[AudioClip],
-                        normalize_durations) -> list[AudioEvent]:
+                        normalize_durations,
+                        candidate_index: Optional[helpers.ClosestValueIndex] = None) -> list[AudioEvent]:
+    # A prebuilt candidate index must have been built from the durations of the substitution clips, in the same
+    # order. Normalized durations depend on the source clip, so they are always indexed here
     result = []
     if not (len(source_clip.events) > 0 and len(substitution_clips) > 0 and len(substitution_clips[0].events) > 0):
         return result
 
-    substitution_events = [event for substitution_clip in substitution_clips for event in substitution_clip.events]
-    candidates = [event.duration for event in substitution_events]
+    substitution_events = candidate_events(substitution_clips)
+    source_durations = source_clip.event_feature("duration")
 
     if normalize_durations:
-        processed_candidate_durations = helpers.normalize(candidates,
-                                                          min(event.duration for event in source_clip.events),
-                                                          max(event.duration for event in source_clip.events))
-    else:
-        processed_candidate_durations = candidates
-
-    for i in range(len(source_clip.events)):
-        closest_index = helpers.get_closest_index(processed_candidate_durations, source_clip.events[i].duration)
-        old_event = source_clip.events[i]
-        new_event = copy.copy(substitution_events[closest_index])
+        normalized_durations = helpers.normalize(candidate_features(substitution_clips, "duration"),
+                                                 source_durations.min(),
+                                                 source_durations.max())
+        candidate_index = helpers.ClosestValueIndex(normalized_durations)
+    elif candidate_index is None:
+        candidate_index = helpers.ClosestValueIndex(candidate_features(substitution_clips, "duration"))
+
+    closest_indexes = candidate_index.query(source_durations)
+    return substitute_events(source_clip, substitution_events, closest_indexes)
+
+
+def shuffle_by_pitch(source_clip: AudioClip,
+                     substitution_clips: list[AudioClip],
+                     duration_tie_break: bool = True,
+                     candidate_index: Optional[helpers.PitchIndex] = None) -> list[AudioEvent]:
+    # Replaces every source event with the substitution event closest in pitch. With the duration tie break, events
+    # within the same semitone are matched by duration instead. A prebuilt candidate index must have been built from
+    # the events of the substitution clips, in the same order
+    substitution_events = candidate_events(substitution_clips)
+    if not (len(source_clip.events) > 0 and len(substitution_events) > 0):
+        return []
+    if candidate_index is None:
+        candidate_index = helpers.PitchIndex(candidate_features(substitution_clips, "pitch"),
+                                             candidate_features(substitution_clips, "duration"),
+                                             semitone_groups=duration_tie_break)
+    closest_indexes = candidate_index.query(source_clip.event_feature("pitch"), source_clip.event_feature("duration"))
+    return substitute_events(source_clip, substitution_events, closest_indexes)
+
+
+def shuffle_by_timbre(source_clip: AudioClip,
+                      substitution_clips: list[AudioClip],
+                      candidate_index: Optional[helpers.NearestNeighbourIndex] = None) -> list[AudioEvent]:
+    # Replaces every source event with the substitution event that sounds most alike. A prebuilt candidate index must
+    # have been built from the events of the substitution clips, in the same order
+    substitution_events = candidate_events(substitution_clips)
+    if not (len(source_clip.events) > 0 and len(substitution_events) > 0):
+        return []
+    if candidate_index is None:
+        candidate_index = build_timbre_index(event_timbre(substitution_events))
+    closest_indexes = candidate_index.query(event_timbre(source_clip.events))
+    return substitute_events(source_clip, substitution_events, closest_indexes)
+
+
+def candidate_events(clips: list[AudioClip]) -> list[AudioEvent]:
+    # The events of a single clip, like a whole library, are used as they are rather than copied into a new list
+    return clips[0].events if len(clips) == 1 else [event for clip in clips for event in clip.events]
+
+
+def candidate_features(clips: list[AudioClip], name: str) -> np.ndarray:
+    return clips[0].event_feature(name) if len(clips) == 1 \
+        else np.concatenate([clip.event_feature(name) for clip in clips])
+
+
+def build_timbre_index(timbre_vectors: np.ndarray) -> helpers.NearestNeighbourIndex:
+    # Every descriptor is scaled by its spread across the candidates, so that no descriptor dominates because of its
+    # unit. The MFCCs share the weight of a single descriptor between them
+    spread = timbre_vectors.std(axis=0) if len(timbre_vectors) > 0 else np.ones(timbre_vectors.shape[1])
+    weights = np.concatenate([[TIMBRE_WEIGHTS[name] for name in features.TIMBRE_DESCRIPTORS],
+                              np.full(features.NUM_MFCC, TIMBRE_WEIGHTS["mfcc"] / np.sqrt(features.NUM_MFCC))])
+    return helpers.NearestNeighbourIndex(timbre_vectors, weights / np.where(spread > 0, spread, 1))
+
+
+def event_timbre(events: list[AudioEvent]) -> np.ndarray:
+    descriptors = {name: [getattr(event, name) for event in events] for name in features.TIMBRE_DESCRIPTORS}
+    descriptors["mfcc"] = np.array([np.zeros(features.NUM_MFCC) if event.mfcc is None else event.mfcc
+                                    for event in events]).reshape(len(events), features.NUM_MFCC)
+    return features.timbre_vectors(descriptors)
+
+
+def substitute_events(source_clip: AudioClip,
+                      substitution_events: list[AudioEvent],
+                      substitution_indexes: np.ndarray) -> list[AudioEvent]:
+    result = []
+    for old_event, substitution_index in zip(source_clip.events, substitution_indexes):
+        new_event = copy.copy(substitution_events[substitution_index])
         new_event.start = old_event.start
         new_event.duration = old_event.duration
-
         result.append(new_event)
     return result
 
@@ -38,59 +110,99 @@ def shuffle_by_duration(source_clip: AudioClip,
 def interleave(source_clip: AudioClip,
                substitution_clips: list[AudioClip],
                event_counts: list[int]) -> list[AudioEvent]:
-    substitution_clips = [source_clip] + substitution_clips
+    clips = [source_clip] + substitution_clips
+    clip_ids, event_ids, _ = interleave_schedule([len(clip.events) for clip in clips], event_counts)
+    # Events come from different clips, so they are laid out back to back from the start of the output
+    return sequence_events(gather_events(clips, clip_ids, event_ids))
+
+
+def interleaved_shuffle(source_clip: AudioClip,
+                        substitution_clips: list[AudioClip],
+                        event_counts: list[int],
+                        rng: np.random.Generator) -> list[AudioEvent]:
+    # The chunks Interleave takes from the clips, played in a random order
+    clips = [source_clip] + substitution_clips
+    clip_ids, event_ids, chunk_lengths = interleave_schedule([len(clip.events) for clip in clips], event_counts)
+    order = rng.permutation(len(chunk_lengths))
+    positions = chunk_ranges((np.cumsum(chunk_lengths) - chunk_lengths)[order], chunk_lengths[order])
+    return sequence_events(gather_events(clips, clip_ids[positions], event_ids[positions]))
+
+
+def interleave_schedule(clip_lengths: list[int], event_counts: list[int]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Chunks of event_counts events are taken from the clips in turn, each continuing where its previous chunk
+    ended, until there are as many events as the longest clip has. Clips that are shorter start over from their first
+    event. Returns the clip and event id of every scheduled event, and the length of every chunk"""
+    clip_lengths = np.asarray(clip_lengths, dtype=np.int64)
+    max_length = int(clip_lengths.max())
+    counts = np.asarray(event_counts, dtype=np.int64)
+    # Enough rounds of event counts for the chunks to add up to the longest clip, of which only the chunks up to and
+    # including the one that gets there are used
+    chunk_lengths = np.tile(counts, max(-(-max_length // int(counts.sum())), 1))
+    num_chunks = int(np.searchsorted(np.cumsum(chunk_lengths), max_length)) + 1
+    chunk_lengths = chunk_lengths[:num_chunks]
+    chunk_clips = np.arange(num_chunks) % len(clip_lengths)
+    # Where every chunk starts in its clip is a running sum over the earlier chunks of the same clip
+    rows = np.pad(chunk_lengths, (0, -num_chunks % len(clip_lengths))).reshape(-1, len(clip_lengths))
+    chunk_starts = (np.cumsum(rows, axis=0) - rows).reshape(-1)[:num_chunks]
+    chunk_lengths[-1] = min(chunk_lengths[-1], max_length - chunk_starts[-1])
+    # Clips without events have nothing to contribute
+    chunk_lengths[clip_lengths[chunk_clips] == 0] = 0
+    clip_ids = np.repeat(chunk_clips, chunk_lengths)
+    event_ids = chunk_ranges(chunk_starts, chunk_lengths) % np.maximum(clip_lengths[clip_ids], 1)
+    return clip_ids, event_ids, chunk_lengths
+
+
+def chunk_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # Concatenation of the ranges start, start + 1, ..., start + length - 1 of every chunk
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+
+
+def gather_events(clips: list[AudioClip], clip_ids: np.ndarray, event_ids: np.ndarray) -> list[AudioEvent]:
+    return [clips[clip_id].events[event_id] for clip_id, event_id in zip(clip_ids.tolist(), event_ids.tolist())]
+
+
+def in_place_schedule(num_events: int, num_clips: int, event_counts: list[int]) -> np.ndarray:
+    # The clip every source event is taken from, moving on to the next clip after each chunk of event_counts events
+    counts = np.asarray(event_counts, dtype=np.int64)
+    chunk_ends = np.cumsum(np.tile(counts, max(-(-num_events // int(counts.sum())), 1)))
+    return np.searchsorted(chunk_ends, np.arange(num_events), side="right") % num_clips
+
+
+def sequence_events(events: list[AudioEvent]) -> list[AudioEvent]:
     result = []
-    lengths = [len(substitution_clip.events) for substitution_clip in substitution_clips]
-    index = 0
-    event_indexes = [0 for length in lengths]
-    chunk_index = 0
-    # click.echo(f"got lengths: {lengths}, event indexes {event_indexes}")
-    max_length = max(lengths)
-    # make sure all clips have the same number of events
-    for i in range(len(substitution_clips)):
-        substitution_clip = substitution_clips[i]
-        while len(substitution_clip.events) < max_length:
-            num_events = len(substitution_clip.events)
-            substitution_clip.events += substitution_clip.events[0:min(num_events, max_length - num_events)]
-        click.echo(f"clip.events # {len(substitution_clip.events)}")
-
-    i = 0
-    while 1:
-        start = event_indexes[index]
-        end = min(start + event_counts[chunk_index], max_length)
-        event_indexes[index] = end
-        result += substitution_clips[index].events[start:end]
-        index = (index + 1) % len(substitution_clips)
-        chunk_index = (chunk_index + 1) % len(event_counts)
-        # if end >= max_length:
-        if sum(event_indexes) >= max_length:
-            break
+    start = 0
+    for event in events:
+        new_event = copy.copy(event)
+        new_event.start = start
+        start += new_event.duration
+        result.append(new_event)
     return result
 
+
 def interleave_in_place(source_clip: AudioClip,
                         substitution_clips: list[AudioClip],
                         event_counts: list[int]) -> list[AudioEvent]:
     substitution_clips = [source_clip] + substitution_clips
     result = []
-    current_clip_ix = 0
-    current_event_count_ix = 0
-    current_event_count = event_counts[current_event_count_ix]
-    for event_ix in range(len(substitution_clips[0].events)):
-        current_event = substitution_clips[0].events[event_ix]
-        current_clip = substitution_clips[current_clip_ix]
-        if current_clip_ix == 0:
+    clip_indexes = in_place_schedule(len(source_clip.events), len(substitution_clips), event_counts)
+    # Look up the closest event of every substitution clip for all source events assigned to it in one go
+    source_start_times = source_clip.event_feature("start")
+    closest_indexes = np.zeros(len(clip_indexes), dtype=np.int64)
+    for clip_ix in range(1, len(substitution_clips)):
+        assigned = clip_indexes == clip_ix
+        if np.any(assigned):
+            event_start_times = substitution_clips[clip_ix].event_feature("start")
+            closest_indexes[assigned] = helpers.get_closest_indexes(event_start_times, source_start_times[assigned])
+
+    for current_event, clip_ix, closest_ix in zip(source_clip.events, clip_indexes, closest_indexes):
+        if clip_ix == 0:
             result.append(current_event)
         else:
-            event_start_times = [event.start for event in current_clip.events]
-            closest_ix = helpers.get_closest_index(event_start_times, current_event.start)
-            old_event = current_clip.events[closest_ix]
-            new_event = AudioEvent(current_event.start, current_event.duration, current_event.pitch, old_event.audio_data, 0, should_fade_in=False)
+            # The substituted event keeps its own audio and descriptors, but takes over the slot of the source event
+            new_event = copy.copy(substitution_clips[clip_ix].events[closest_ix])
+            new_event.start = current_event.start
+            new_event.duration = current_event.duration
             new_event.should_fade_in = False
             result.append(new_event)
-        current_event_count -= 1
-        if current_event_count <= 0:
-            current_event_count_ix = (current_event_count_ix + 1) % len(event_counts)
-            current_event_count = event_counts[current_event_count_ix]
-            current_clip_ix = (current_clip_ix + 1) % len(substitution_clips)
 
     return result
\ No newline at end of file
@@ -1,7 +1,177 @@
+import pathlib
+import tempfile
+
+import numpy as np
+
+import benchmark
+import fades
+import generation
 import helpers
+import strategies
+from analysis_cache import AnalysisCache
 
 nums = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
 norm_nums = helpers.normalize(nums, 50, 100)
 print(norm_nums)
 print("closest index is:", helpers.get_closest_index(norm_nums, 89),
       norm_nums[helpers.get_closest_index(norm_nums, 89)])
+
+
+# The loops the vectorized versions replaced, which they are checked against below
+
+def linear_closest_index(number_list, target):
+    if len(number_list) == 0:
+        return 0
+    smallest_diff = abs(number_list[0] - target)
+    closest_index = 0
+    for i, number in enumerate(number_list[1:], 1):
+        diff = abs(number - target)
+        if diff < smallest_diff:
+            smallest_diff = diff
+            closest_index = i
+    return closest_index
+
+
+def loop_interleave(clip_lengths, event_counts):
+    # Shorter clips were padded by repeating their events, so an event id past the end of a clip starts over
+    max_length = max(clip_lengths)
+    event_indexes = [0 for _ in clip_lengths]
+    result = []
+    index = 0
+    chunk_index = 0
+    while 1:
+        start = event_indexes[index]
+        end = min(start + event_counts[chunk_index], max_length)
+        event_indexes[index] = end
+        result += [(index, event_ix % clip_lengths[index]) for event_ix in range(start, end)]
+        index = (index + 1) % len(clip_lengths)
+        chunk_index = (chunk_index + 1) % len(event_counts)
+        if sum(event_indexes) >= max_length:
+            break
+    return result
+
+
+def loop_in_place(num_events, num_clips, event_counts):
+    result = []
+    current_clip_ix = 0
+    current_event_count_ix = 0
+    current_event_count = event_counts[current_event_count_ix]
+    for _ in range(num_events):
+        result.append(current_clip_ix)
+        current_event_count -= 1
+        if current_event_count <= 0:
+            current_event_count_ix = (current_event_count_ix + 1) % len(event_counts)
+            current_event_count = event_counts[current_event_count_ix]
+            current_clip_ix = (current_clip_ix + 1) % num_clips
+    return result
+
+
+rng = np.random.default_rng(0)
+for _ in range(1000):
+    # Small integer ranges give plenty of ties, which the lowest index has to win as before
+    values = rng.integers(0, 20, rng.integers(1, 30)).tolist()
+    targets = rng.integers(-5, 25, 10).tolist()
+    expected = [linear_closest_index(values, target) for target in targets]
+    assert helpers.get_closest_indexes(values, targets).tolist() == expected, (values, targets)
+
+    clip_lengths = rng.integers(1, 40, rng.integers(1, 5)).tolist()
+    event_counts = rng.integers(1, 16, rng.integers(1, 5)).tolist()
+    clip_ids, event_ids, _ = strategies.interleave_schedule(clip_lengths, event_counts)
+    assert list(zip(clip_ids.tolist(), event_ids.tolist())) == loop_interleave(clip_lengths, event_counts), \
+        (clip_lengths, event_counts)
+
+    num_events = int(rng.integers(0, 100))
+    num_clips = int(rng.integers(1, 5))
+    assert strategies.in_place_schedule(num_events, num_clips, event_counts).tolist() == \
+        loop_in_place(num_events, num_clips, event_counts), (num_events, num_clips, event_counts)
+print("get_closest_indexes, interleave_schedule and in_place_schedule match the loops they replaced")
+
+
+def loop_fades(packed, offsets, lengths, should_fade_in, sample_rate, shape):
+    # One event at a time, the way AudioEvent.apply_fade faded them before they were batched
+    in_curve, out_curve = fades.fade_curves(sample_rate, shape)
+    result = packed.copy()
+    for offset, length, fade_in in zip(offsets, lengths, should_fade_in):
+        audio = result[..., offset:offset + length]
+        if fade_in and length > len(in_curve):
+            audio[..., :len(in_curve)] *= in_curve
+        if length > len(out_curve):
+            audio[..., -len(out_curve):] *= out_curve
+    return result
+
+
+def linear_pitch_match(pitches, durations, target_pitch, target_duration, semitone_groups):
+    # The closest pitch first, the lowest one on ties, then the closest duration within it, the shorter one on ties
+    if semitone_groups:
+        pitches = np.round(pitches)
+    unique_pitches = sorted(set(pitches.tolist()))
+    pitch = unique_pitches[linear_closest_index(unique_pitches, target_pitch)]
+    group_durations = sorted(durations[pitches == pitch].tolist())
+    return pitch, group_durations[linear_closest_index(group_durations, target_duration)]
+
+
+for _ in range(200):
+    sample_rate = int(rng.choice([22050, 44100, 48000]))
+    shape = str(rng.choice(["power", "equal_power", "linear"]))
+    in_length, out_length = fades.fade_lengths(sample_rate)
+    # Lengths around both curve lengths, where events go from unfaded to faded on one side or both
+    lengths = rng.choice([1, in_length, in_length + 1, out_length, out_length + 1, in_length + out_length,
+                          int(rng.integers(1, 3 * out_length))], int(rng.integers(1, 20)))
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    should_fade_in = rng.random(len(lengths)) < 0.5
+    dtype = rng.choice([np.float32, np.float64])
+    packed = rng.standard_normal((int(rng.integers(1, 3)), int(lengths.sum()))).astype(dtype)
+    expected = loop_fades(packed, offsets, lengths, should_fade_in, sample_rate, shape)
+    fades.apply_fades(packed, offsets, lengths, should_fade_in, sample_rate, shape)
+    assert np.array_equal(packed, expected), (sample_rate, shape, lengths.tolist(), should_fade_in.tolist())
+
+    count = int(rng.integers(1, 40))
+    # Quarter tones and repeated durations give ties in pitch and in duration
+    pitches = rng.integers(40, 60, count) + rng.choice([0.0, 0.25, 0.5], count)
+    durations = rng.integers(1, 10, count) * 100
+    target_pitches = rng.integers(35, 65, 10) + rng.choice([0.0, 0.25, 0.5], 10)
+    target_durations = rng.integers(-1, 12, 10) * 100
+    for semitone_groups in [True, False]:
+        matches = helpers.PitchIndex(pitches, durations, semitone_groups).query(target_pitches, target_durations)
+        matched_pitches = np.round(pitches[matches]) if semitone_groups else pitches[matches]
+        expected = [linear_pitch_match(pitches, durations, target_pitch, target_duration, semitone_groups)
+                    for target_pitch, target_duration in zip(target_pitches, target_durations)]
+        assert list(zip(matched_pitches.tolist(), durations[matches].tolist())) == expected, \
+            (pitches.tolist(), durations.tolist(), semitone_groups)
+assert helpers.PitchIndex([], []).query([60.0], [100]).tolist() == [0]
+print("apply_fades matches the per-event loop it replaced and PitchIndex matches a linear search")
+
+for weights in [[1, 2, 3, 4], [0, 5, 0, 1, 0], [0.1, 0, 10, 0.5, 3, 0, 2], [0, 0, 0], [7]]:
+    alias_table = helpers.AliasTable(weights)
+    # Each column is drawn 1 / n of the time and gives its own index or its alias, so the exact distribution follows
+    # from the table
+    table_distribution = np.bincount(alias_table.aliases, weights=1 - alias_table.probabilities, minlength=len(weights))
+    table_distribution = (table_distribution + alias_table.probabilities) / len(weights)
+    expected = np.array(weights) / sum(weights) if sum(weights) > 0 else np.full(len(weights), 1 / len(weights))
+    assert np.allclose(table_distribution, expected), weights
+    samples = alias_table.sample(np.random.default_rng(0), 200000)
+    assert np.abs(np.bincount(samples, minlength=len(weights)) / len(samples) - expected).max() < 0.01, weights
+    if sum(weights) > 0:
+        assert not np.isin(samples, np.flatnonzero(np.array(weights) == 0)).any(), weights
+print("AliasTable draws indexes in proportion to their weights and never draws a zero weight")
+
+
+def clip_events(clip):
+    return [(event.start, event.duration, event.pitch, event.rms, event.source.offset) for event in clip.events]
+
+
+# A clip must have the same events whether or not the analysis of its file is cached, including clips converted to
+# another sample rate and clips cut from files longer than the split threshold
+with tempfile.TemporaryDirectory() as directory:
+    corpus = benchmark.build_corpus(pathlib.Path(directory, "corpus"), 12, 0)
+    analysis_cache = AnalysisCache(pathlib.Path(directory, "cache"))
+    for file in corpus:
+        for offset_fraction, sample_rate in [(0.0, None), (0.3, None), (0.7, 48000), (0.9, 22050)]:
+            uncached = generation.get_audio_clip(str(file), offset_fraction, 7, False, "specflux", None, sample_rate)
+            # Analysed and stored on the first call, loaded from the cache on the second
+            for _ in range(2):
+                cached = generation.get_audio_clip(str(file), offset_fraction, 7, False, "specflux", analysis_cache,
+                                                   sample_rate)
+                assert clip_events(cached) == clip_events(uncached), (file, offset_fraction, sample_rate)
+            assert all(event.duration > 0 for event in uncached.events), (file, offset_fraction, sample_rate)
+print("get_audio_clip gives the same events with and without the analysis cache")